@@ -1,45 +1,228 @@
-# This is a hack to allow running headless e.g. Jenkins
 import os
-import warnings
+import sys
+import importlib
+import importlib.util
 
-if not os.environ.get('DISPLAY'):
-    import matplotlib
+# Limit the thread pools of numerical libraries to a single thread, unless
+# explicitly configured otherwise, to avoid oversubscribing cores when one
+# process is launched per core. Only effective if set before NumPy/SciPy are
+# imported.
+if not os.environ.get('NEAT_ALLOW_BLAS_THREADS'):
+    for _var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+        os.environ.setdefault(_var, '1')
+    del _var
 
-    matplotlib.use('Agg')
+# modules and the public names they define, modules are only imported when
+# one of their names is first accessed (PEP 562)
+_SPEC = (
+    ('neat.trees.stree', ('STree', 'SNode')),
+    ('neat.trees.morphtree', ('MorphTree', 'MorphNode', 'MorphLoc')),
+    ('neat.trees.phystree', ('PhysTree', 'PhysNode')),
+    ('neat.trees.sovtree', ('SOVTree', 'SOVNode', 'SomaSOVNode')),
+    ('neat.trees.greenstree', ('GreensTree', 'GreensNode', 'SomaGreensNode')),
+    ('neat.trees.netree', ('NET', 'NETNode', 'Kernel')),
+    ('neat.trees.compartmenttree', ('CompartmentTree', 'CompartmentNode')),
+    ('neat.tools.simtools.neuron.neuronmodel', ('NeuronSimTree',
+                                                'NeuronSimNode',
+                                                'NeuronCompartmentTree',
+                                                'createReducedNeuronModel')),
+    ('neat.tools.kernelextraction', ('FourrierTools', 'FourierTools')),
+    ('neat.channels.ionchannels', ('IonChannel',)),
+    ('neat.tools.fittools.compartmentfitter', ('CompartmentFitter',)),
+)
+_LAZY = {name: module_name for module_name, names in _SPEC for name in names}
 
-from neat.trees.stree import STree
-from neat.trees.stree import SNode
+# explicit, so that star-imports do not iterate (and load) the full namespace
+__all__ = list(_LAZY) + ['enableNeuron']
 
-from neat.trees.morphtree import MorphTree
-from neat.trees.morphtree import MorphNode
-from neat.trees.morphtree import MorphLoc
+_NEURON_MODULE = 'neat.tools.simtools.neuron.neuronmodel'
 
-from neat.trees.phystree import PhysTree
-from neat.trees.phystree import PhysNode
+# whether NEURON can be imported, determined without importing it
+__NEURON_AVAILABLE__ = importlib.util.find_spec('neuron') is not None
 
-from neat.trees.sovtree import SOVTree
-from neat.trees.sovtree import SOVNode, SomaSOVNode
 
-from neat.trees.greenstree import GreensTree
-from neat.trees.greenstree import GreensNode, SomaGreensNode
+def _neuronMissing(name):
+    """
+    Placeholder for a NEURON-dependent name, raises an `ImportError` when it
+    is instantiated or called.
+    """
+    msg = 'NEURON not available, install `neuron` to use `%s`' % name
 
-from neat.trees.netree import NET
-from neat.trees.netree import NETNode
-from neat.trees.netree import Kernel
+    def raise_import_error(*args, **kwargs):
+        raise ImportError(msg)
 
-from neat.trees.compartmenttree import CompartmentTree
-from neat.trees.compartmenttree import CompartmentNode
+    if name[0].isupper():
+        return type(name, (), {'__init__': raise_import_error, '__doc__': msg})
+    else:
+        raise_import_error.__name__ = name
+        raise_import_error.__doc__ = msg
+        return raise_import_error
 
-try:
-    from neat.tools.simtools.neuron.neuronmodel import NeuronSimTree
-    from neat.tools.simtools.neuron.neuronmodel import NeuronSimNode
-    from neat.tools.simtools.neuron.neuronmodel import NeuronCompartmentTree
-    from neat.tools.simtools.neuron.neuronmodel import createReducedNeuronModel
-except ModuleNotFoundError:
-    warnings.warn('NEURON not available', UserWarning)
 
-from neat.tools.kernelextraction import FourrierTools
+def _importModule(module_name):
+    """
+    Import a module of the public API, returns `None` for the NEURON model
+    module when `neuron` is not installed.
+    """
+    try:
+        return importlib.import_module(module_name)
+    except ModuleNotFoundError as e:
+        if module_name != _NEURON_MODULE or e.name != 'neuron':
+            raise
+        return None
 
-from neat.channels.ionchannels import IonChannel
 
-from neat.tools.fittools.compartmentfitter import CompartmentFitter
+def _bindModule(module_name, module):
+    """
+    Bind all public names of a module in the package namespace, so that later
+    lookups bypass `__getattr__`.
+    """
+    names = dict(_SPEC)[module_name]
+    if module is None:
+        values = {n: _neuronMissing(n) for n in names}
+    else:
+        values = {n: getattr(module, n) for n in names}
+    globals().update(values)
+
+    return values
+
+
+_neuron_enabled = False
+
+
+def enableNeuron():
+    """
+    Import NEURON and bind the NEURON simulation names (`NeuronSimTree`,
+    `NeuronSimNode`, `NeuronCompartmentTree` and `createReducedNeuronModel`)
+    in the package namespace.
+
+    Accessing one of these names calls this function implicitly, calling it
+    explicitly moves the cost of loading NEURON to a predictable site.
+
+    Raises
+    ------
+        ImportError
+            If NEURON is not installed
+    """
+    global _neuron_enabled
+    if not _neuron_enabled:
+        _bindModule(_NEURON_MODULE, importlib.import_module(_NEURON_MODULE))
+        _neuron_enabled = True
+
+
+# suggestions for misspelled names, only computed when a lookup fails
+_suggestions = {}
+
+
+def _suggest(name):
+    if name not in _suggestions:
+        import difflib
+        _suggestions[name] = difflib.get_close_matches(name, __all__, n=3)
+
+    return _suggestions[name]
+
+
+def __getattr__(name):
+    try:
+        module_name = _LAZY[name]
+    except KeyError:
+        msg = "module %r has no attribute %r" % (__name__, name)
+        suggestions = [] if name.startswith('_') else _suggest(name)
+        if suggestions:
+            msg += ". Did you mean: %s?" % ", ".join(map(repr, suggestions))
+        raise AttributeError(msg)
+
+    if module_name == _NEURON_MODULE:
+        try:
+            enableNeuron()
+        except ModuleNotFoundError as e:
+            if e.name != 'neuron':
+                raise
+            import logging
+            logging.getLogger(__name__).info('NEURON not available')
+            _bindModule(module_name, None)
+        return globals()[name]
+
+    return _bindModule(module_name, _importModule(module_name))[name]
+
+
+def __dir__():
+    return list(globals()) + [name for name in _LAZY if name not in globals()]
+
+
+_loaded = False
+
+
+def _loadAll(max_workers=4):
+    """
+    Import all modules of the public API and bind their names.
+
+    The modules are imported concurrently on a thread pool, except in
+    development mode or when import times are profiled, where they are
+    imported sequentially to keep the import traces readable.
+
+    Parameters
+    ----------
+        max_workers: int
+            The number of threads in the pool, the modules are imported
+            sequentially if `max_workers <= 1`
+    """
+    global _loaded, _neuron_enabled
+    if _loaded:
+        return
+
+    module_names = [module_name for module_name, _ in _SPEC]
+    if max_workers <= 1 or sys.flags.dev_mode or \
+       'importtime' in sys._xoptions or \
+       os.environ.get('PYTHONPROFILEIMPORTTIME'):
+        modules = [_importModule(module_name) for module_name in module_names]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            modules = list(pool.map(_importModule, module_names))
+
+    # rebind the names on the calling thread
+    for module_name, module in zip(module_names, modules):
+        _bindModule(module_name, module)
+    _neuron_enabled = modules[module_names.index(_NEURON_MODULE)] is not None
+
+    _loaded = True
+
+
+def _afterForkInChild():
+    """
+    Give forked workers (e.g. `multiprocessing`, `joblib`) their own global
+    NumPy random state, instead of replaying the stream of the parent. Only
+    registered by `_warmup`, so that seeded runs remain reproducible
+    otherwise.
+    """
+    if 'numpy' in sys.modules:
+        sys.modules['numpy'].random.seed()
+
+
+def _warmup():
+    """
+    Load the full public API in a process that will fork workers, and move
+    the loaded objects out of reach of the garbage collector, so that the
+    children share the memory pages of the parent instead of copying them
+    when the collector touches the objects.
+    """
+    # sequential, as some modules import from `neat` itself, which may still
+    # be initializing here
+    _loadAll(max_workers=1)
+    import gc
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_afterForkInChild)
+
+# `NEAT_LAZY=0` loads the full public API at import, e.g. for profiling.
+# `NEAT_PREWARM=1` additionally prepares the loaded state to be shared with
+# forked workers.
+if os.environ.get('NEAT_PREWARM') == '1':
+    _warmup()
+elif os.environ.get('NEAT_LAZY') == '0':
+    _loadAll(max_workers=1)
@@ -0,0 +1,40 @@
+"""
+Selection of the matplotlib backend, this is a hack to allow running headless
+e.g. Jenkins.
+
+Author: W. Wybo
+"""
+
+import os
+import sys
+
+
+def isHeadless():
+    """
+    Whether the session has no display to draw interactive figures on.
+
+    True on Linux without an X11 or Wayland display, on CI runners
+    (`CI=true`), or when explicitly requested with `NEAT_HEADLESS=1`. macOS
+    and Windows sessions are assumed to have a display, as they do not use
+    the `DISPLAY` variable.
+    """
+    return bool(
+        (sys.platform.startswith('linux') and \
+         not os.environ.get('DISPLAY') and \
+         not os.environ.get('WAYLAND_DISPLAY')) or \
+        os.environ.get('CI', '').lower() == 'true' or \
+        os.environ.get('NEAT_HEADLESS')
+    )
+
+
+def ensureAgg():
+    """
+    Select the non-interactive 'Agg' backend in headless sessions.
+
+    The backend is set through the `MPLBACKEND` environment variable, which
+    matplotlib reads at its first import, so this function does not import
+    matplotlib itself and has no effect when matplotlib is already imported.
+    Set `NEAT_SKIP_MPL=1` to leave the backend selection to matplotlib.
+    """
+    if isHeadless() and not os.environ.get('NEAT_SKIP_MPL'):
+        os.environ.setdefault('MPLBACKEND', 'Agg')
@@ -1,9 +1,23 @@
 import sympy as sp
+from sympy.printing.c import C99CodePrinter
+from sympy.printing.precedence import PRECEDENCE
 import numpy as np
 import scipy.optimize as so
 
 import os
-import copy
+import re
+import sys
+import glob
+import hashlib
+import inspect
+import textwrap
+import functools
+import importlib.util
+
+try:
+    import numba
+except ModuleNotFoundError:
+    numba = None
 
 CONC_DICT = {'na': 10., # mM
              'k': 54.4, # mM
@@ -16,6 +30,144 @@ E_ION_DICT = {'na': 50.,
             }
 
 
+# templates of the generated code, blocks of a variable number of lines are
+# filled in with their trailing newlines
+_MOD_TEMPLATE = textwrap.dedent("""\
+    : This mod file is automaticaly generated by the ``neat.channels.ionchannels`` module
+
+    NEURON {{
+        SUFFIX I{cname}
+    {ion_statements}    RANGE  g, e
+        GLOBAL {varstring}, {taustring}
+        THREADSAFE
+    }}
+
+    PARAMETER {{
+        g = {g} (S/cm2)
+        e = {e} (mV)
+    {conc_parameters}}}
+
+    UNITS {{
+        (mA) = (milliamp)
+        (mV) = (millivolt)
+        (mM) = (milli/liter)
+    }}
+
+    ASSIGNED {{
+        i{ion} (mA/cm2)
+    {assigned}    v (mV)
+    }}
+
+    STATE {{
+    {states}}}
+
+    BREAKPOINT {{
+        SOLVE states METHOD cnexp
+        i{ion} = g * ({p_open}) * (v - e)
+    }}
+
+    INITIAL {{
+        rates(v{conc_args})
+    {initial}}}
+
+    DERIVATIVE states {{
+        rates(v{conc_args})
+    {derivatives}}}
+
+    PROCEDURE rates(v{conc_params}) {{
+    {rates}}}
+
+""")
+
+_H_TEMPLATE = textwrap.dedent("""\
+    class {cname}: public IonChannel{{
+    private:
+    {members}    double m_dt = -1.;
+        double m_p_open_eq = 0.0, m_p_open = 0.0;
+        bool m_newton_valid = false;
+        double m_v_newton = 0.0;
+        void evalNewton(double v);
+    public:
+        void calcFunStatevar(double v) override;
+        double calcPOpen() override;
+        void calcPOpenBatch(int n, const double* const* x, double* p_open) override;
+        void setPOpen() override;
+        void setPOpenEQ(double v) override;
+        void precomputeDt(double dt) override;
+        void advance(double dt) override;
+        double getCond() override;
+        double getCondNewton() override;
+        double f(double v) override;
+        double DfDv(double v) override;
+        void setfNewtonConstant(double* vs, int v_size) override;
+        double fNewton(double v) override;
+        double DfDvNewton(double v) override;
+    }};
+
+""")
+
+_CC_TEMPLATE = textwrap.dedent("""\
+    void {cname}::calcFunStatevar(double v){{
+    {calc_fun_statevar}}}
+    double {cname}::calcPOpen(){{
+    {p_open_temps}    return {p_open};
+    }}
+    // `x[k]` and `p_open` have to be allocated with `allocBatch`, their 64 byte
+    // alignment is assumed
+    void {cname}::calcPOpenBatch(int n, const double* const* x, double* __restrict__ p_open){{
+        p_open = (double*)__builtin_assume_aligned(p_open, 64);
+    {batch_pointers}    #pragma omp simd
+        for(int i = 0; i < n; i++){{
+    {batch_statevars}{p_open_batch_temps}        p_open[i] = {p_open_batch};
+        }}
+    }}
+    void {cname}::setPOpen(){{
+        m_p_open = calcPOpen();
+    }}
+    void {cname}::setPOpenEQ(double v){{
+        calcFunStatevar(v);
+    {set_statevars_eq}{p_open_eq_temps}    m_p_open_eq ={p_open_eq};
+    }}
+    void {cname}::precomputeDt(double dt){{
+    {precompute_dt}    m_dt = dt;
+    }}
+    void {cname}::advance(double dt){{
+    {advance}}}
+    double {cname}::getCond(){{
+        return m_g_bar * (m_p_open - m_p_open_eq);
+    }}
+    double {cname}::getCondNewton(){{
+        return m_g_bar;
+    }}
+    double {cname}::f(double v){{
+        return (m_e_rev - v);
+    }}
+    double {cname}::DfDv(double v){{
+        return -1.;
+    }}
+    void {cname}::setfNewtonConstant(double* vs, int v_size){{
+        if(v_size != {n_statevar})
+            cerr << "input arg [vs] has incorrect size, should have same size as number of channel state variables" << endl;
+    {set_v_statevars}    m_newton_valid = false;
+    }}
+    void {cname}::evalNewton(double v){{
+        if(m_newton_valid && v == m_v_newton)
+            return;
+    {eval_newton}    m_v_newton = v;
+        m_newton_valid = true;
+    }}
+    double {cname}::fNewton(double v){{
+        evalNewton(v);
+    {f_newton}    return (m_e_rev - v) * ({p_newton} - m_p_open_eq);
+    }}
+    double {cname}::DfDvNewton(double v){{
+        evalNewton(v);
+    {dfdv_newton}    return -1. * ({dfdv_p_newton} - m_p_open_eq) + ({dp_newton}) * (m_e_rev - v);
+    }}
+
+""")
+
+
 class _func(object):
     def __init__(self, eval_func_aux, eval_func_vtrap, e_trap):
         self.eval_func_aux = eval_func_aux
@@ -30,19 +182,21 @@ class _func(object):
             else:
                 return self.eval_func_aux(*args)
         else:
-            fv_return = np.zeros_like(vv)
-            bool_vtrap = np.abs(vv - self.e_trap) < 0.0001
-            inds_vtrap = np.where(bool_vtrap)
-            args_ = [a[inds_vtrap] for a in args]
-            fv_return[inds_vtrap] = self.eval_func_vtrap(*args_)
-            inds = np.where(np.logical_not(bool_vtrap))
-            args_ = [a[inds] for a in args]
-            fv_return[inds] = self.eval_func_aux(*args_)
-            return fv_return
+            # evaluate both branches everywhere and select, the singular
+            # points of `eval_func_aux` are discarded
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fv_aux = self.eval_func_aux(*args)
+            fv_vtrap = self.eval_func_vtrap(*args)
+            return np.where(np.abs(vv - self.e_trap) < 0.0001, fv_vtrap, fv_aux)
+
+
+@functools.lru_cache(maxsize=None)
+def _function_regex(functions):
+    return re.compile(r'\b(' + '|'.join(map(re.escape, functions)) + r')\b')
 
 
 def _insert_function_prefixes(string, prefix='np',
-                              functions=['exp', 'sin', 'cos', 'tan', 'pi']):
+                              functions=('exp', 'sin', 'cos', 'tan', 'pi')):
     """
     Prefix all occurences in the input `string` of the functions in the
     `functions` list with the provided `prefix`.
@@ -53,9 +207,9 @@ def _insert_function_prefixes(string, prefix='np',
         the input string
     prefix: string, optional
         the prefix that is put before each function. Defaults to `'np'`
-    functions: list of strings, optional
-        the list of functions that will be prefixed. Defaults to
-        `['exp', 'sin', 'cos', 'tan', 'pi']`
+    functions: iterable of strings, optional
+        the functions that will be prefixed. Defaults to
+        `('exp', 'sin', 'cos', 'tan', 'pi')`
 
     Returns
     -------
@@ -64,20 +218,231 @@ def _insert_function_prefixes(string, prefix='np',
     Examples
     --------
     >>> _insert_function_prefixes('5. * exp(0.) + 3. * cos(pi)')
-    '5. * np.exp(0.) + 3. * np.cos(pi)'
+    '5. * np.exp(0.) + 3. * np.cos(np.pi)'
     """
-    for func_name in functions:
-        numpy_string = ''
-        while len(string) > 0:
-            ind = string.find(func_name)
-            if ind == -1:
-                numpy_string += string
-                string = ''
-            else:
-                numpy_string += string[0:ind] + prefix + '.' + func_name
-                string = string[ind+len(func_name):]
-        string = numpy_string
-    return string
+    func_re = _function_regex(tuple(functions))
+    return func_re.sub(lambda m: prefix + '.' + m.group(1), string)
+
+
+def _jit(func, cache=False):
+    """
+    Compile a lambdified function to native code with numba, if it is
+    installed. If numba fails to compile the function or to convert its
+    result, the original function is used from then on, and if a cached
+    compilation fails to load, the function is compiled again without the
+    cache. Calls on which the compiled function raises an arithmetic error
+    (e.g. a division by zero, where numpy returns inf or nan) are evaluated
+    by the original function.
+
+    Parameters
+    ----------
+    func: callable
+        the function returned by `sympy.lambdify`
+    cache: bool, optional
+        whether numba caches the compiled function on disk, requires the
+        source of `func` to be in a module file. Defaults to `False`
+
+    Returns
+    -------
+    callable
+    """
+    if numba is None:
+        return func
+
+    func_jit = numba.njit(func, cache=cache)
+
+    def f(*args):
+        nonlocal func_jit, cache
+        if func_jit is not None:
+            try:
+                return func_jit(*args)
+            except (numba.core.errors.NumbaError, TypeError):
+                # typing errors, or results numba can not convert to Python
+                func_jit = None
+            except ImportError:
+                # the cached compilation could not be loaded
+                func_jit = numba.njit(func) if cache else None
+                cache = False
+                return f(*args)
+            except ArithmeticError:
+                pass
+        return func(*args)
+
+    return f
+
+
+def _loadFromCache(func, cache_dir):
+    """
+    Write the source of a lambdified function to a module file in
+    `cache_dir`, named after the hash of the source, and load the function
+    from that module.
+
+    Parameters
+    ----------
+    func: callable
+        the function returned by `sympy.lambdify`
+    cache_dir: str
+        the cache directory
+
+    Returns
+    -------
+    callable
+    """
+    src = inspect.getsource(func)
+    name = 'neat_lambdified_' + hashlib.sha1(src.encode()).hexdigest()
+    path = os.path.join(cache_dir, name + '.py')
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # write under a temporary name first, so that concurrent processes
+        # never import a partial file
+        path_tmp = '%s.%d' % (path, os.getpid())
+        with open(path_tmp, 'w') as file:
+            file.write(src)
+        os.replace(path_tmp, path)
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # the namespace in which lambdify evaluated the function
+    module.__dict__.update({key: val for key, val in func.__globals__.items() \
+                            if not key.startswith('__')})
+    # numba imports the module by name when it loads a cached compilation
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return getattr(module, func.__name__)
+
+
+def _asTuple(expr):
+    """
+    Convert (nested) lists of expressions to tuples, so that the lambdified
+    function returns a tuple. Numba can return tuples mixing scalars and
+    arrays, whereas such lists fail when they are converted to Python objects.
+    """
+    if isinstance(expr, (list, tuple)):
+        return tuple(_asTuple(ex) for ex in expr)
+    return expr
+
+
+def _lambdify(args, expr):
+    """
+    Lambdify `expr` with common subexpression elimination, and compile it
+    with numba if it is installed.
+
+    If the environment variable `NEAT_CACHE_DIR` is set, the generated source
+    is stored in that directory, so that numba can cache the compiled
+    function on disk and later processes skip the compilation.
+
+    Parameters
+    ----------
+    args: sympy.Symbol or list of sympy.Symbol
+        the arguments of the function
+    expr: sympy.expression or list of sympy.expression
+        the expression(s) to be evaluated
+
+    Returns
+    -------
+    callable
+    """
+    func = sp.lambdify(args, _asTuple(expr), cse=True)
+    cache_dir = os.environ.get('NEAT_CACHE_DIR')
+    if numba is None or not cache_dir:
+        return _jit(func)
+
+    try:
+        func = _loadFromCache(func, os.path.expanduser(cache_dir))
+    except (OSError, ImportError):
+        return _jit(func)
+    return _jit(func, cache=True)
+
+
+def _constant(value):
+    """
+    Function returning the constant `value`, as an array of the same shape as
+    its first argument if that is an array. Replaces the lambdified function
+    of a constant expression.
+
+    Parameters
+    ----------
+    value: float
+        the constant
+
+    Returns
+    -------
+    callable
+    """
+    def f(v, *args):
+        if isinstance(v, np.ndarray):
+            return np.full(v.shape, value)
+        return value
+
+    return f
+
+
+class _CCodePrinter(C99CodePrinter):
+    """
+    C code printer that writes small integer powers as products, which are
+    cheaper than calls to `pow`.
+    """
+    def _print_Pow(self, expr):
+        if expr.exp.is_Integer and 2 <= abs(int(expr.exp)) <= 4:
+            base = self.parenthesize(expr.base, PRECEDENCE['Mul'])
+            prod = '*'.join([base] * abs(int(expr.exp)))
+            return f'({prod})' if expr.exp > 0 else f'1.0/({prod})'
+        return super()._print_Pow(expr)
+
+
+_CCODE_PRINTER = _CCodePrinter()
+
+
+def _ccode(expr):
+    """
+    C code of the sympy expression `expr` for the generated C++ code.
+    """
+    return _CCODE_PRINTER.doprint(expr)
+
+
+def _cse_ccode(exprs, symbols, indent='    '):
+    """
+    Common subexpression elimination on `exprs` for the generated C++ code.
+
+    Parameters
+    ----------
+    exprs: list of sympy.expression
+        the expressions
+    symbols: iterator of sympy.Symbol
+        the names of the temporaries, shared between all calls within a
+        generated function so that the names are unique
+    indent: str, optional
+        indentation of the declarations of the temporaries
+
+    Returns
+    -------
+    str
+        the declarations of the temporaries, one per line
+    list of str
+        the c code of the reduced expressions
+    """
+    temps, reduced = sp.cse([sp.sympify(expr) for expr in exprs],
+                            symbols=symbols)
+    decls = ''.join(f'{indent}double {symb} = {_ccode(expr)};\n' \
+                    for symb, expr in temps)
+    return decls, [_ccode(expr) for expr in reduced]
+
+
+def modHash(path):
+    """
+    Return the hash of the names and contents of all mod files in `path`,
+    used to skip the compilation of unchanged mechanisms
+    """
+    sha = hashlib.sha1()
+    for mod_file in sorted(glob.glob(os.path.join(path, '*.mod'))):
+        sha.update(os.path.basename(mod_file).encode())
+        with open(mod_file, 'rb') as file:
+            sha.update(file.read())
+    return sha.hexdigest()
 
 
 class IonChannel(object):
@@ -126,6 +491,14 @@ class IonChannel(object):
         TODO
     """
 
+    # lambdified functions, shared between instances with identical
+    # symbolic expressions
+    _LAMBDIFY_CACHE = {}
+    # voltage tables, constructed by `buildTables()`
+    _v_table = None
+    _varinf_table = None
+    _tauinf_table = None
+
     def __init__(self):
         """
         Will give an ``AttributeError`` if initialized as is. Should only be
@@ -168,8 +541,12 @@ class IonChannel(object):
         del d['f_statevar']
         del d['f_varinf']
         del d['f_tauinf']
-        del d['f_p_open']
+        del d['f_varinf_vec'], d['f_tauinf_vec']
+        del d['f_varinf_point'], d['f_tauinf_point']
+        del d['f_p_open'], d['f_p_open_point']
         del d['dp_dx'], d['df_dv'], d['df_dx'], d['df_dc']
+        del d['_linear_terms'], d['_lambdified']
+        del d['_p_open_cache'], d['_varinf_cache'], d['_tauinf_cache']
         # del d['f_s00']
 
         return d
@@ -183,22 +560,57 @@ class IonChannel(object):
         # restore them
         self.setLambdaFuncs()
 
+    def _lambdifyKey(self):
+        """
+        Key identifying the symbolic expressions of the channel, channels with
+        equal keys can share their lambdified functions.
+        """
+        exprs = [self.p_open] + \
+                [expr for arr in (self.statevars, self.varinf,
+                                  self.tauinf, self.fstatevar) \
+                      for expr in arr.flat]
+        return (self.__class__.__name__, self.sp_v,
+                tuple((ion, CONC_DICT[ion]) for ion in self.concentrations),
+                tuple(str(expr) for expr in exprs))
+
     def setLambdaFuncs(self):
-        # construct lambda function for state variables
-        self.f_statevar = self.lambdifyFStatevar()
-        # construct lambda functions for steady state activation
-        self.f_varinf = self.lambdifyVarInf()
-        # construct lambda functions for state variable time scales
-        self.f_tauinf = self.lambdifyTauInf()
-        # construct lambda function for passive opening
-        self.f_p_open = self.lambdifyPOpen()
-        # construct lambda function for linear current coefficient evaluations
-        self.dp_dx, self.df_dv, self.df_dx, self.df_dc = \
-                        self.lambdifyDerivatives()
+        key = self._lambdifyKey()
+        try:
+            funcs = IonChannel._LAMBDIFY_CACHE[key]
+        except KeyError:
+            funcs = {}
+            # construct lambda function for state variables
+            funcs['f_statevar'] = self.lambdifyFStatevar()
+            # construct lambda functions for steady state activation
+            funcs['f_varinf'] = self.lambdifyVarInf()
+            # construct lambda functions for state variable time scales
+            funcs['f_tauinf'] = self.lambdifyTauInf()
+            # vectorized versions, evaluating all state variables in one call
+            funcs['f_varinf_vec'] = self.lambdifyVec(self.varinf)
+            funcs['f_tauinf_vec'] = self.lambdifyVec(self.tauinf)
+            # versions on the `math` module, for evaluations at single points
+            funcs['f_varinf_point'] = self.lambdifyPoint(self.varinf,
+                                                         funcs['f_varinf_vec'])
+            funcs['f_tauinf_point'] = self.lambdifyPoint(self.tauinf,
+                                                         funcs['f_tauinf_vec'])
+            # construct lambda function for passive opening
+            funcs['f_p_open'] = self.lambdifyPOpen()
+            funcs['f_p_open_point'] = self.lambdifyPOpenPoint(funcs['f_p_open'])
+            # construct lambda function for linear current coefficient evaluations
+            funcs['dp_dx'], funcs['df_dv'], funcs['df_dx'], funcs['df_dc'], \
+            funcs['_linear_terms'] = self.lambdifyDerivatives()
+            IonChannel._LAMBDIFY_CACHE[key] = funcs
+        self.__dict__.update(funcs)
+        self._lambdified = funcs
+        # memoized evaluations at scalar voltages, optimizers tend to probe
+        # the same points repeatedly
+        self._p_open_cache = functools.lru_cache(maxsize=4096)(self._computePOpenPoint)
+        self._varinf_cache = functools.lru_cache(maxsize=4096)(self.f_varinf_point)
+        self._tauinf_cache = functools.lru_cache(maxsize=4096)(self.f_tauinf_point)
         # express statevar[0,0] as a function of the other state variables
         self.po = sp.symbols('po')
 
-        sv_aux = [sv for ii, sv in np.ndenumerate(self.statevars)]
+        sv_aux = list(self.statevars.flat)
 
         # # sol = sp.solve(self.p_open - self.po, self.statevars[0,0])
         # sol = sp.solve(self.p_open - self.po, sv_aux)
@@ -217,80 +629,181 @@ class IonChannel(object):
     def lambdifyVarInf(self):
         f_varinf = np.zeros(self.varnames.shape, dtype=object)
         for ind, varinf in np.ndenumerate(self.varinf):
-            varinf = self._substituteConc(varinf)
-            f_varinf[ind] = sp.lambdify(self.sp_v, varinf)
+            varinf = sp.sympify(self._substituteConc(varinf))
+            if varinf.free_symbols:
+                f_varinf[ind] = _lambdify(self.sp_v, varinf)
+            else:
+                f_varinf[ind] = _constant(float(varinf))
         return f_varinf
 
     def lambdifyTauInf(self):
         f_tauinf = np.zeros(self.varnames.shape, dtype=object)
         for ind, tauinf in np.ndenumerate(self.tauinf):
-            tauinf = self._substituteConc(tauinf)
-            f_tauinf[ind] = sp.lambdify(self.sp_v, tauinf)
+            tauinf = sp.sympify(self._substituteConc(tauinf))
+            if tauinf.free_symbols:
+                f_tauinf[ind] = _lambdify(self.sp_v, tauinf)
+            else:
+                f_tauinf[ind] = _constant(float(tauinf))
         return f_tauinf
 
+    def lambdifyVec(self, exprs):
+        """
+        Lambdify an array of voltage dependent expressions as a single
+        function.
+
+        Parameters
+        ----------
+        exprs: numpy.ndarray of sympy.expression instances
+            the expressions, should have the same shape as `self.varnames`
+
+        Returns
+        -------
+        callable
+            Takes the voltage `v` as argument and returns an array of shape
+            ``self.varnames.shape + numpy.shape(v)``
+        """
+        shape = self.varnames.shape
+        exprs = [sp.sympify(self._substituteConc(expr)) \
+                 for expr in exprs.flat]
+        if not any(expr.free_symbols for expr in exprs):
+            values = np.array([float(expr) for expr in exprs])
+            def f_vec(v):
+                res = np.multiply.outer(values, np.ones(np.shape(v)))
+                return res.reshape(shape + np.shape(v))
+            return f_vec
+
+        f_list = _lambdify(self.sp_v, exprs)
+        def f_vec(v):
+            # constant expressions evaluate to scalars, broadcast them to the
+            # shape of `v`
+            res = np.array(np.broadcast_arrays(v, *f_list(v))[1:], dtype=float)
+            return res.reshape(shape + np.shape(v))
+        return f_vec
+
+    def lambdifyPoint(self, exprs, f_vec):
+        """
+        Lambdify an array of voltage dependent expressions on the `math`
+        module, which is cheaper than numpy for evaluations at a single
+        voltage.
+
+        Parameters
+        ----------
+        exprs: numpy.ndarray of sympy.expression instances
+            the expressions, should have the same shape as `self.varnames`
+        f_vec: callable
+            the function returned by `lambdifyVec` for `exprs`, evaluated
+            instead where `math` raises (e.g. on overflow)
+
+        Returns
+        -------
+        callable
+            Takes a float voltage `v` as argument and returns an array of
+            shape ``self.varnames.shape``
+        """
+        shape = self.varnames.shape
+        exprs = [sp.sympify(self._substituteConc(expr)) \
+                 for expr in exprs.flat]
+        f_list = sp.lambdify(self.sp_v, exprs, modules='math', cse=True)
+        def f_point(v):
+            try:
+                return np.array(f_list(v), dtype=float).reshape(shape)
+            except (ArithmeticError, ValueError):
+                return f_vec(v)
+        return f_point
+
     def lambdifyPOpen(self):
         # arguments for lambda function
-        args = [self.sp_v] + [statevar for ind, statevar in np.ndenumerate(self.statevars)]
+        args = [self.sp_v] + list(self.statevars.flat)
         # return lambda function
-        return sp.lambdify(args, self.p_open)
+        p_open = sp.sympify(self.p_open)
+        if not p_open.free_symbols:
+            return _constant(float(p_open))
+        return _lambdify(args, p_open)
+
+    def lambdifyPOpenPoint(self, f_p_open):
+        """
+        Lambdify the open probability on the `math` module, for evaluations
+        at a single point, `f_p_open` is evaluated instead where `math` raises.
+        """
+        args = [self.sp_v] + list(self.statevars.flat)
+        f_math = sp.lambdify(args, self.p_open, modules='math', cse=True)
+        def f_point(*args):
+            try:
+                return f_math(*args)
+            except (ArithmeticError, ValueError):
+                return f_p_open(*args)
+        return f_point
 
     def lambdifyFStatevar(self):
         # arguments for lambda function
-        args = [self.sp_v] + [statevar for ind, statevar in np.ndenumerate(self.statevars)]
+        args = [self.sp_v] + list(self.statevars.flat)
         # return lambda function
-        return sp.lambdify(args, self.fstatevar)
+        return _lambdify(args, np.asarray(self.fstatevar).tolist())
+
+    def _linearExprs(self):
+        """
+        The open probability followed by its derivatives to the state
+        variables, the derivatives of the state variable functions to the
+        voltage, to the state variables and to each concentration, all flat.
+        """
+        inds = [ind for ind, _ in np.ndenumerate(self.statevars)]
+        sv_flat = sp.Matrix([self.statevars[ind] for ind in inds])
+        fsv_flat = sp.Matrix([self.fstatevar[ind] for ind in inds])
+        f_svs = self._substituteConc(fsv_flat)
+        # open probability, needed together with the derivatives for the
+        # linearized current
+        exprs = [self.p_open]
+        # open probability derivatives to state vars
+        exprs += list(sp.Matrix([self.p_open]).jacobian(sv_flat))
+        # state variable derivatives to voltage and state variable, the
+        # latter only depend on their own state variable
+        exprs += list(f_svs.jacobian(sp.Matrix([self.sp_v])))
+        exprs += list(f_svs.jacobian(sv_flat).diagonal())
+        # state variable derivatives to concentrations, one column per
+        # concentration
+        if len(self.sp_c) > 0:
+            df_dc = self._substituteConc(fsv_flat.jacobian(sp.Matrix(self.sp_c)))
+            exprs += list(df_dc.T)
+
+        return exprs
 
     def lambdifyDerivatives(self):
         # arguments for lambda function
-        args = [self.sp_v] + [statevar for ind, statevar in np.ndenumerate(self.statevars)]
-        # compute open probability derivatives to state vars
-        dp_dx_aux = np.zeros(self.statevars.shape, dtype=object)
-        for ind, var in np.ndenumerate(self.statevars):
-            dp_dx_aux[ind] = sp.lambdify(args,
-                                     sp.diff(self.p_open, var, 1))
-        # compute state variable derivatives
-        df_dv_aux = np.zeros(self.statevars.shape, dtype=object)
-        df_dx_aux = np.zeros(self.statevars.shape, dtype=object)
-        df_dc_aux = [np.zeros(self.statevars.shape, dtype=object) for _ in self.sp_c]
-        # differentiate
-        for ind, var in np.ndenumerate(self.statevars):
-            f_sv = self.fstatevar[ind]
-            # derivatives to concentrations
-            for ii, sp_c in enumerate(self.sp_c):
-                df_dc_aux[ii][ind] = sp.lambdify(args,
-                                        self._substituteConc(sp.diff(f_sv, sp_c, 1)))
-            # derivative to voltage and state variable
-            f_sv = self._substituteConc(f_sv)
-            df_dv_aux[ind] = sp.lambdify(args,
-                                     sp.diff(f_sv, self.sp_v, 1))
-            df_dx_aux[ind] = sp.lambdify(args,
-                                     sp.diff(f_sv, var, 1))
+        args = [self.sp_v] + list(self.statevars.flat)
+        n_sv, n_c = self.statevars.size, len(self.sp_c)
+        exprs = self._linearExprs()
+        # single function, so that subexpressions are shared between the open
+        # probability and all derivatives
+        f_derivatives = _lambdify(args, exprs)
+
+        # the derivatives are grouped per row of the state variables
+        shape = (self.statevars.shape[0], n_sv // self.statevars.shape[0])
+        def group(vals, args):
+            # constant derivatives evaluate to scalars, broadcast them to
+            # the shape of the arguments
+            vals = np.broadcast_arrays(*vals, *args)[:len(vals)]
+            return np.array(vals).reshape(shape + vals[0].shape)
 
         # define convenient functions
+        def linear_terms(*args):
+            vals = f_derivatives(*args)
+            p_open = vals[0]
+            dp_dx = group(vals[1:n_sv+1], args)
+            df_dv = group(vals[n_sv+1:2*n_sv+1], args)
+            df_dx = group(vals[2*n_sv+1:3*n_sv+1], args)
+            return p_open, dp_dx, df_dv, df_dx
         def dp_dx(*args):
-            dp_dx_list = [[] for _ in range(self.statevars.shape[0])]
-            for ind, dp_dx_ in np.ndenumerate(dp_dx_aux):
-                dp_dx_list[ind[0]].append(dp_dx_aux[ind](*args))
-            return np.array(dp_dx_list)
+            return group(f_derivatives(*args)[1:n_sv+1], args)
         def df_dv(*args):
-            df_dv_list = [[] for _ in range(self.statevars.shape[0])]
-            for ind, df_dv_ in np.ndenumerate(df_dv_aux):
-                df_dv_list[ind[0]].append(df_dv_aux[ind](*args))
-            return np.array(df_dv_list)
+            return group(f_derivatives(*args)[n_sv+1:2*n_sv+1], args)
         def df_dx(*args):
-            df_dx_list = [[] for _ in range(self.statevars.shape[0])]
-            for ind, df_dx_ in np.ndenumerate(df_dx_aux):
-                df_dx_list[ind[0]].append(df_dx_aux[ind](*args))
-            return np.array(df_dx_list)
+            return group(f_derivatives(*args)[2*n_sv+1:3*n_sv+1], args)
         def df_dc(*args):
-            df_dc_list = []
-            for ic, (sp_c, df_dc__) in enumerate(zip(self.sp_c, df_dc_aux)):
-                df_dc_list.append([[] for _ in range(self.statevars.shape[0])])
-                for ind, df_dc_ in np.ndenumerate(df_dc__):
-                    df_dc_list[-1][ind[0]].append(df_dc__[ind](*args))
-            return np.array(df_dc_list)
+            vals = f_derivatives(*args)
+            return np.array([group(vals[(3+ic)*n_sv+1:(4+ic)*n_sv+1], args) \
+                             for ic in range(n_c)])
 
-        return dp_dx, df_dv, df_dx, df_dc
+        return dp_dx, df_dv, df_dx, df_dc, linear_terms
 
     def expansionPointAsString(self, v, statevars=None):
         if statevars is None:
@@ -305,100 +818,251 @@ class IonChannel(object):
         rstring += 'p_open = %.4f'%(p_open)
         return rstring
 
-    def computePOpen(self, v, statevars=None):
+    def _isPoint(self, v, statevars=None):
+        """
+        Whether `v` is a single real voltage and `statevars` a single real
+        set of state variables, so that evaluations can be memoized.
+        """
+        return np.ndim(v) == 0 and np.isrealobj(v) and \
+               (statevars is None or \
+                (isinstance(statevars, np.ndarray) and \
+                 statevars.shape == self.varnames.shape and \
+                 np.isrealobj(statevars)))
+
+    def _computePOpenPoint(self, v, sv=None):
+        if sv is None:
+            sv = self._varinf_cache(v).flat
+        return self.f_p_open_point(v, *sv)
+
+    def _evalArgs(self, v, statevars=None):
+        """
+        Arguments for the lambdified functions, the state variables default to
+        their steady state values at `v`.
+        """
         if statevars is None:
-            args = [v] + [f_varinf(v) for _, f_varinf in np.ndenumerate(self.f_varinf)]
+            return [v] + list(self.computeVarInf(v).reshape(-1, *np.shape(v)))
         else:
-            args = [v] + [var0 for var0 in statevars.reshape(-1, *statevars.shape[2:])]
-        return self.f_p_open(*args)
+            return [v] + [var0 for var0 in statevars.reshape(-1, *statevars.shape[2:])]
+
+    def _computePOpen(self, v, statevars=None):
+        return self.f_p_open(*self._evalArgs(v, statevars=statevars))
+
+    def computePOpen(self, v, statevars=None):
+        if self._isPoint(v, statevars):
+            sv = None if statevars is None else tuple(statevars.flat)
+            return self._p_open_cache(float(v), sv)
+        return self._computePOpen(v, statevars=statevars)
 
     def computeDerivatives(self, v, statevars=None):
-        if statevars is None:
-            args = [v] + [f_varinf(v) for _, f_varinf in np.ndenumerate(self.f_varinf)]
-        else:
-            args = [v] + [var0 for var0 in statevars.reshape(-1, *statevars.shape[2:])]
-        return self.dp_dx(*args), self.df_dv(*args), self.df_dx(*args)
+        return self._linear_terms(*self._evalArgs(v, statevars=statevars))[1:]
 
     def computeDerivativesConc(self, v, statevars=None):
-        if statevars is None:
-            args = [v] + [f_varinf(v) for _, f_varinf in np.ndenumerate(self.f_varinf)]
-        else:
-            args = [v] + [var0 for var0 in statevars.reshape(-1, *statevars.shape[2:])]
-        return self.df_dc(*args)
+        return self.df_dc(*self._evalArgs(v, statevars=statevars))
+
+    def buildTables(self, v_min=-100., v_max=50., dv=0.05, dtype=np.float32):
+        """
+        Tabulate the activations and time scales of the state variables on a
+        voltage grid. Afterwards, `computeVarInf` and `computeTauInf` linearly
+        interpolate the tables for voltages within ``[v_min, v_max]``, instead
+        of evaluating the expressions.
+
+        Parameters
+        ----------
+        v_min: float
+            lower bound of the voltage grid [mV]
+        v_max: float
+            upper bound of the voltage grid [mV]
+        dv: float
+            step of the voltage grid [mV]
+        dtype: numpy dtype
+            the data type of the tables, the default single precision halves
+            the memory traffic of the lookups
+        """
+        v_table = np.arange(v_min, v_max + dv / 2., dv)
+        self._v_table = v_table
+        self._varinf_table = np.ascontiguousarray(
+            self.f_varinf_vec(v_table).reshape(-1, len(v_table)), dtype=dtype)
+        self._tauinf_table = np.ascontiguousarray(
+            self.f_tauinf_vec(v_table).reshape(-1, len(v_table)), dtype=dtype)
+
+    def clearTables(self):
+        """
+        Remove the tables constructed by `buildTables`, so that activations
+        and time scales are again evaluated from their expressions.
+        """
+        self._v_table = None
+        self._varinf_table = None
+        self._tauinf_table = None
+
+    def _inTable(self, v):
+        return self._v_table is not None and \
+               np.isrealobj(v) and \
+               np.all(v >= self._v_table[0]) and np.all(v <= self._v_table[-1])
+
+    def _interpTable(self, table, v):
+        v_table = self._v_table
+        x = (np.asarray(v, dtype=float) - v_table[0]) / (v_table[1] - v_table[0])
+        i0 = np.clip(np.floor(x).astype(int), 0, len(v_table) - 2)
+        w1 = x - i0
+        res = table[:, i0] * (1. - w1) + table[:, i0+1] * w1
+        return res.reshape(self.varnames.shape + np.shape(v))
 
     def computeVarInf(self, v):
-        if isinstance(v, np.ndarray):
-            dims = tuple(list(tuple(self.f_varinf.shape)) + list(v.shape))
-            slice_ind = [slice(dd) for dd in v.shape]
-        else:
-            dims = self.f_varinf.shape
-            slice_ind = []
-        res = np.zeros(dims)
-        for ind, f_varinf in np.ndenumerate(self.f_varinf):
-            ind_slice = tuple(list(ind) + slice_ind)
-            res[ind_slice] = f_varinf(v)
-        return res
+        if self._inTable(v):
+            return self._interpTable(self._varinf_table, v)
+        if self._isPoint(v):
+            return self._varinf_cache(float(v)).copy()
+        return self.f_varinf_vec(v)
 
     def computeTauInf(self, v):
-        if isinstance(v, np.ndarray):
-            dims = tuple(list(tuple(self.f_tauinf.shape)) + list(v.shape))
-            slice_ind = [slice(dd) for dd in v.shape]
-        else:
-            dims = self.f_tauinf.shape
-            slice_ind = []
-        res = np.zeros(dims)
-        for ind, f_tauinf in np.ndenumerate(self.f_tauinf):
-            ind_slice = tuple(list(ind) + slice_ind)
-            res[ind_slice] = f_tauinf(v)
+        if self._inTable(v):
+            return self._interpTable(self._tauinf_table, v)
+        if self._isPoint(v):
+            return self._tauinf_cache(float(v)).copy()
+        return self.f_tauinf_vec(v)
+
+    def _flatStatevars(self, freqs, *arrs):
+        """
+        Reshape arrays of derivatives, of shape ``(n_row, n_col) + shape``, to
+        a single leading state variable axis, with the trailing axes padded so
+        that they broadcast against `freqs`.
+        """
+        res = []
+        for arr in arrs:
+            shape = arr.shape[2:]
+            n_pad = max(np.ndim(freqs) - len(shape), 0)
+            res.append(arr.reshape((-1,) + (1,) * n_pad + shape))
         return res
 
+    def _linearSum(self, freqs, dp_dx_arr, df_arr, df_dx_arr):
+        dp_dx_arr, df_arr, df_dx_arr = self._flatStatevars(freqs,
+                    dp_dx_arr, df_arr, df_dx_arr)
+        df_arr = df_arr * 1e3 # convert to 1 / s
+        df_dx_arr = df_dx_arr * 1e3 # convert to 1 / s
+        # sum the impedance contributions of the state variables
+        return np.sum(dp_dx_arr * df_arr / (freqs - df_dx_arr), axis=0)
+
     def computeLinear(self, v, freqs, statevars=None):
-        dp_dx_arr, df_dv_arr, df_dx_arr = self.computeDerivatives(v, statevars=statevars)
-        lin_f = np.zeros_like(freqs)
-        for ind, dp_dx_ in np.ndenumerate(dp_dx_arr):
-            df_dv_ = df_dv_arr[ind] * 1e3 # convert to 1 / s
-            df_dx_ = df_dx_arr[ind] * 1e3 # convert to 1 / s
-            # add to the impedance contribution
-            lin_f += dp_dx_ * df_dv_ / (freqs - df_dx_)
-        return lin_f
+        return self._linearSum(freqs,
+                    *self.computeDerivatives(v, statevars=statevars))
 
     def computeLinearConc(self, v, freqs, ion, statevars=None):
         ind_c = self.concentrations.index(ion)
         dp_dx_arr, df_dv_arr, df_dx_arr = self.computeDerivatives(v, statevars=statevars)
         df_dc = self.computeDerivativesConc(v, statevars=statevars)
-        lin_f = np.zeros_like(freqs)
-        for ind, dp_dx_ in np.ndenumerate(dp_dx_arr):
-            df_dc_ = df_dc[ind_c][ind] * 1e3 # convert to 1 / s
-            df_dx_ = df_dx_arr[ind] * 1e3 # convert to 1 / s
-            # add to the impedance contribution
-            lin_f += dp_dx_ * df_dc_ / (freqs - df_dx_)
-        return lin_f
+        return self._linearSum(freqs, dp_dx_arr, df_dc[ind_c], df_dx_arr)
 
     def computeLinSum(self, v, freqs, e_rev, statevars=None):
-        return (e_rev - v) * self.computeLinear(v, freqs, statevars=statevars) - \
-               self.computePOpen(v, statevars=statevars)
+        # open probability and derivatives from a single evaluation
+        p_open, dp_dx_arr, df_dv_arr, df_dx_arr = \
+                self._linear_terms(*self._evalArgs(v, statevars=statevars))
+        return (e_rev - v) * self._linearSum(freqs, dp_dx_arr, df_dv_arr, df_dx_arr) - \
+               p_open
     # def computeLinSum(self, v, freqs, e_rev, statevars=None):
     #     return - self.computePOpen(v, statevars=statevars)
 
     def computeLinConc(self, v, freqs, e_rev, ion, statevars=None):\
         return (e_rev - v) * self.computeLinearConc(v, freqs, ion, statevars=statevars)
 
-    def findMaxCurrent(self, freqs, e_rev):
+    def _linSumObjective(self):
+        """
+        Native version of the objective of `findMaxCurrent`, the inverse of
+        the absolute summed `computeLinSum`, as a function of the flat array
+        `[v, statevars...]`, the frequencies as a flat complex array and the
+        reversal. Returns `None` if numba is not installed.
+        """
+        if numba is None:
+            return None
+        try:
+            return self._lambdified['_lin_sum_objective']
+        except KeyError:
+            pass
+
+        n_sv = self.statevars.size
+        args = [self.sp_v] + list(self.statevars.flat)
+        exprs = self._linearExprs()[:3*n_sv+1]
+        # single array argument, unpacked in the generated code
+        f_terms = numba.njit(sp.lambdify([args], exprs, cse=True))
+
+        @numba.njit
+        def f_obj(xx, freqs, e_rev):
+            vals = f_terms(xx)
+            lin_f = np.zeros_like(freqs)
+            for kk in range(1, n_sv+1):
+                lin_f += vals[kk] * vals[n_sv+kk] * 1e3 / \
+                         (freqs - vals[2*n_sv+kk] * 1e3)
+            return 1. / np.abs(np.sum((e_rev - xx[0]) * lin_f - vals[0]))
+
+        self._lambdified['_lin_sum_objective'] = f_obj
+        return f_obj
+
+    def _findMaxObjective(self, freqs, e_rev, v=None):
+        """
+        Objective of `findMaxCurrent`, or `findMaxCurrentVGiven` if `v` is
+        given, compiled with numba if possible.
+        """
         def f_min(xx):
+            if v is not None:
+                xx = np.concatenate(([v], xx))
             xv = xx[1:].reshape(self.statevars.shape)
             val = 1. / np.abs(np.sum(self.computeLinSum(xx[0], freqs, e_rev, statevars=xv)))
             return val
-        # optimization
-        x0 = [-45.] + [0.5 for _ in range(self.statevars.size)]
+
+        f_obj = self._linSumObjective()
+        if f_obj is None:
+            return f_min
+        freqs_ = np.asarray(freqs, dtype=complex).reshape(-1)
+        e_rev_ = float(e_rev)
+        def f_min_jit(xx):
+            nonlocal f_obj
+            if f_obj is not None:
+                xx_ = np.asarray(xx, dtype=float)
+                if v is not None:
+                    xx_ = np.concatenate(([v], xx_))
+                try:
+                    return f_obj(xx_, freqs_, e_rev_)
+                except numba.core.errors.NumbaError:
+                    f_obj = None
+                except ArithmeticError:
+                    pass
+            return f_min(xx)
+        return f_min_jit
+
+    def findMaxCurrent(self, freqs, e_rev):
+        f_min = self._findMaxObjective(freqs, e_rev)
+        # maximum on a voltage grid, with the state variables at their
+        # steady state values, evaluated in one sweep
+        v_grid = np.linspace(-90., 0., 181)
+        v_grid_ = v_grid.reshape(v_grid.shape + (1,) * np.ndim(freqs))
+        sv_grid = self.computeVarInf(v_grid_)
+        lin_sum = self.computeLinSum(v_grid_, freqs, e_rev, statevars=sv_grid)
+        i_grid = np.abs(np.sum(lin_sum.reshape(len(v_grid), -1), axis=1))
+        # rate functions evaluate to nan at their removable singularities
+        i_grid[~np.isfinite(i_grid)] = -np.inf
+        i_max = np.argmax(i_grid)
+        # bounded refinement between the neighbours of the grid maximum
+        def f_v(v):
+            sv = np.clip(self.computeVarInf(v).reshape(-1), 0., 1.)
+            val = f_min(np.concatenate(([v], sv)))
+            return val if np.isfinite(val) else np.inf
+        res_v = so.minimize_scalar(f_v, method='bounded',
+                    bounds=(v_grid[max(i_max-1, 0)],
+                            v_grid[min(i_max+1, len(v_grid)-1)]))
+        x_grid = [res_v['x']] + \
+                 list(np.clip(self.computeVarInf(res_v['x']).reshape(-1), 0., 1.))
+        # joint optimization of voltage and state variables, from the default
+        # initialization and from the refined grid maximum, the optimum may lie
+        # away from the steady state
+        x_init = [-45.] + [0.5 for _ in range(self.statevars.size)]
         bounds = [(-90., 0.)] + [(0., 1.) for _ in range(self.statevars.size)]
-        res = so.minimize(f_min, x0, bounds=bounds)
+        results = [so.minimize(f_min, x0, bounds=bounds) \
+                   for x0 in (x_init, x_grid)]
+        res = min(results, key=lambda res: res['fun'] \
+                  if np.isfinite(res['fun']) else np.inf)
         return res['x'][0], res['x'][1:].reshape(self.statevars.shape)
 
     def findMaxCurrentVGiven(self, v, freqs, e_rev):
-        def f_min(xx):
-            xv = xx.reshape(self.statevars.shape)
-            val = 1. / np.abs(np.sum(self.computeLinSum(v, freqs, e_rev, statevars=xv)))
-            return val
+        f_min = self._findMaxObjective(freqs, e_rev, v=v)
         # optimization
         x0 = [0.5 for _ in range(self.statevars.size)]
         bounds = [(0., 1.) for _ in range(self.statevars.size)]
@@ -406,6 +1070,17 @@ class IonChannel(object):
         return res['x'].reshape(self.statevars.shape)
 
     def findStatevarsVPGiven(self, v, p_open):
+        # for a single product of state variables, `f0 * prod(x_i^n_i)`, all
+        # state variables at the same value solve the problem in closed form
+        factors = getattr(self, 'factors', ())
+        if len(factors) == 1:
+            n_tot = np.sum(self.powers)
+            ratio = p_open / float(factors[0])
+            if n_tot > 0 and ratio > 0.:
+                x_eq = ratio**(1. / n_tot)
+                if 0.1 <= x_eq <= 0.9:
+                    return np.full(self.statevars.shape, x_eq)
+
         def f_object(xx):
             xv = xx.reshape(self.statevars.shape)
             return np.abs(p_open - self.computePOpen(v, statevars=xv))
@@ -518,122 +1193,103 @@ class IonChannel(object):
         # optimization function
         def f_min(freq, u, e_r):
             return -np.abs(self.computeLinSum(u, 1j*freq, e_r))
-        # find minima
+        # locate the maxima for all voltages at once on a logarithmic grid
+        v_arr = np.array(v, dtype=float)
+        f_grid = np.geomspace(max(f_bounds[0], 1e-3), f_bounds[1], 2048)
+        lin_sum = self.computeLinSum(v_arr[..., None], 1j*f_grid, e_rev)
+        i_max = np.argmax(np.abs(lin_sum), axis=-1)
+        # refine each maximum between the neighbouring grid points
+        freq_vals = np.zeros_like(v_arr)
+        for ind, vv in np.ndenumerate(v_arr):
+            f0 = f_grid[i_max[ind]-1] if i_max[ind] > 0 else f_bounds[0]
+            f1 = f_grid[min(i_max[ind]+1, len(f_grid)-1)]
+            res = so.minimize_scalar(f_min, bounds=(f0, f1), args=(vv, e_rev),
+                                     method='bounded')
+            freq_vals[ind] = res['x']
+
         if hasattr(v, '__iter__') or hasattr(v, '__getitem__'):
-            freq_vals = np.zeros_like(np.array(v))
-            for ind, vv in np.ndenumerate(v):
-                res = so.minimize_scalar(f_min, bounds=f_bounds, args=(vv, e_rev))
-                freq_vals[ind] = res['x']
             return freq_vals
         else:
-            return so.minimize_scalar(f_min, bounds=f_bounds, args=(v, e_rev))['x']
+            return freq_vals.item()
+
+    def _cseRates(self, varinfs, tauinfs):
+        """
+        Common subexpression elimination across the activations and time
+        scales of all state variables, for the generated code.
+
+        Returns
+        -------
+        temps: list of tuples `(sympy.Symbol, sympy.expression)`
+            the temporaries to be evaluated first, in order
+        varinfs: list of sympy.expression
+            the activations in terms of the temporaries
+        tauinfs: list of sympy.expression
+            the time scales in terms of the temporaries
+        """
+        exprs = [sp.sympify(expr) for expr in list(varinfs) + list(tauinfs)]
+        temps, reduced = sp.cse(exprs, symbols=sp.numbered_symbols('cse'))
+        n_var = len(varinfs)
+        return temps, reduced[:n_var], reduced[n_var:]
 
     def writeModFile(self, path, g=0., e=0.):
         """
         Writes a modfile of the ion channel for simulations with neuron
         """
-        modname = 'I' + self.__class__.__name__ + '.mod'
+        cname =  self.__class__.__name__
+        modname = f'I{cname}.mod'
         fname = os.path.join(path, modname)
+        n_var = len(self.varinf.flatten())
 
-        file = open(fname, 'w')
-
-        file.write(': This mod file is automaticaly generated by the ' +
-                    '``neat.channels.ionchannels`` module\n\n')
-
-        file.write('NEURON {\n')
-        cname =  self.__class__.__name__
-        file.write('    SUFFIX I' + cname + '\n')
         if self.ion == '':
-            file.write('    NONSPECIFIC_CURRENT i' + '\n')
+            ion_statements = '    NONSPECIFIC_CURRENT i\n'
         else:
-            file.write('    USEION ' + self.ion + ' WRITE i' + self.ion + '\n')
-        if len(self.concentrations) > 0:
-            for concstring in self.concentrations:
-                file.write('    USEION ' + concstring + ' READ ' \
-                                      + concstring + 'i' + '\n')
-        file.write('    RANGE  g, e' + '\n')
-        varstring = 'var0inf'
-        taustring = 'tau0'
-        for ind in range(len(self.varinf.flatten()[1:])):
-            varstring += ', var' + str(ind+1) + 'inf'
-            taustring += ', tau' + str(ind+1)
-        file.write('    GLOBAL ' + varstring + ', ' + taustring + '\n')
-        file.write('    THREADSAFE' + '\n')
-        file.write('}\n\n')
-
-        file.write('PARAMETER {\n')
-        file.write('    g = ' + str(g*1e-6) + ' (S/cm2)' + '\n')
-        file.write('    e = ' + str(e) + ' (mV)' + '\n')
-        for ion in self.concentrations:
-            file.write('    ' + ion + 'i (mM)' + '\n')
-        file.write('}\n\n')
-
-        file.write('UNITS {\n')
-        file.write('    (mA) = (milliamp)' + '\n')
-        file.write('    (mV) = (millivolt)' + '\n')
-        file.write('    (mM) = (milli/liter)' + '\n')
-        file.write('}\n\n')
-
-        file.write('ASSIGNED {\n')
-        file.write('    i' + self.ion + ' (mA/cm2)' + '\n')
-        # if self.ion != '':
-        #     f.write('    e' + self.ion + ' (mV)' + '\n')
-        for ind in range(len(self.varinf.flatten())):
-            file.write('    var' + str(ind) + 'inf' + '\n')
-            file.write('    tau' + str(ind) + ' (ms)' + '\n')
-        file.write('    v (mV)' + '\n')
-        file.write('}\n\n')
-
-        file.write('STATE {\n')
-        for ind in range(len(self.varinf.flatten())):
-            file.write('    var' + str(ind) + '\n')
-        file.write('}\n\n')
-
-        file.write('BREAKPOINT {\n')
-        file.write('    SOLVE states METHOD cnexp' + '\n')
-        calcstring = '    i' + self.ion + ' = g * ('
+            ion_statements = f'    USEION {self.ion} WRITE i{self.ion}\n'
+        ion_statements += ''.join(f'    USEION {ion} READ {ion}i\n' \
+                                  for ion in self.concentrations)
+
+        # open probability as product of the state variables
         ll = 0
+        terms = []
         for ii in range(self.statevars.shape[0]):
+            term = ''
             for jj in range(self.statevars.shape[1]):
-                for kk in range(self.powers[ii,jj]):
-                    calcstring += ' var' + str(ll) + ' *'
+                term += f' var{ll} *' * self.powers[ii,jj]
                 ll += 1
-            calcstring += str(self.factors[ii])
-            if ii < self.statevars.shape[0] - 1:
-                calcstring += ' + '
-        # calcstring += ') * (v - e' + self.ion + ')'
-        calcstring += ') * (v - e)'
-        file.write(calcstring + '\n')
-        file.write('}\n\n')
-
-        concstring = ''
-        for ion in self.concentrations:
-            concstring += ', ' + ion + 'i'
-        file.write('INITIAL {\n')
-        file.write('    rates(v' + concstring + ')' + '\n')
-        for ind in range(len(self.varinf.flatten())):
-            file.write('    var' + str(ind) + ' = var' + str(ind) + 'inf' + '\n')
-        file.write('}\n\n')
-
-        file.write('DERIVATIVE states {\n')
-        file.write('    rates(v' + concstring + ')' + '\n')
-        for ind in range(len(self.varinf.flatten())):
-            file.write('    var' + str(ind) + '\' = (var' + str(ind) \
-                        + 'inf - var' + str(ind) + ') / tau' + str(ind) + '\n')
-        file.write('}\n\n')
-
-        concstring = ''
-        for ion in self.concentrations:
-            concstring += ', ' + ion
-        file.write('PROCEDURE rates(v' + concstring + ') {\n')
-        for ind, varinf in enumerate(self.varinf.flatten()):
-            file.write('    var' + str(ind) + 'inf = ' \
-                            + sp.printing.ccode(varinf) + '\n')
-            file.write('    tau' + str(ind) + ' = ' \
-                            + sp.printing.ccode(self.tauinf.flatten()[ind]) + '\n')
-        file.write('}\n\n')
-
-        file.close()
+            terms.append(term + str(self.factors[ii]))
+
+        temps, varinfs, tauinfs = self._cseRates(self.varinf.flatten(),
+                                                 self.tauinf.flatten())
+        rates = ''
+        if len(temps) > 0:
+            rates += f'    LOCAL {", ".join(str(symb) for symb, _ in temps)}\n'
+        rates += ''.join(f'    {symb} = {sp.printing.ccode(expr)}\n' \
+                         for symb, expr in temps)
+        rates += ''.join(f'    var{ind}inf = {sp.printing.ccode(varinf)}\n'
+                         f'    tau{ind} = {sp.printing.ccode(tauinf)}\n' \
+                         for ind, (varinf, tauinf) in enumerate(zip(varinfs, tauinfs)))
+
+        modcode = _MOD_TEMPLATE.format(
+            cname=cname,
+            ion=self.ion,
+            ion_statements=ion_statements,
+            varstring=', '.join(f'var{ind}inf' for ind in range(n_var)),
+            taustring=', '.join(f'tau{ind}' for ind in range(n_var)),
+            g=g*1e-6,
+            e=e,
+            conc_parameters=''.join(f'    {ion}i (mM)\n' for ion in self.concentrations),
+            assigned=''.join(f'    var{ind}inf\n    tau{ind} (ms)\n' for ind in range(n_var)),
+            states=''.join(f'    var{ind}\n' for ind in range(n_var)),
+            p_open=' + '.join(terms),
+            conc_args=''.join(f', {ion}i' for ion in self.concentrations),
+            initial=''.join(f'    var{ind} = var{ind}inf\n' for ind in range(n_var)),
+            derivatives=''.join(f'    var{ind}\' = (var{ind}inf - var{ind}) / tau{ind}\n' \
+                                for ind in range(n_var)),
+            conc_params=''.join(f', {ion}' for ion in self.concentrations),
+            rates=rates,
+        )
+
+        with open(fname, 'w') as file:
+            file.write(modcode)
 
         return modname
 
@@ -642,199 +1298,173 @@ class IonChannel(object):
         Warning: concentration dependent ion channels get constant concentrations
         substituted for c++ simulation
         """
-
-        fcc = open(os.path.join(path, 'Ionchannels.cc'), 'a')
-        fh = open(os.path.join(path, 'Ionchannels.h'), 'a')
-        # fstruct = open('cython_code/channelstruct.h', 'a')
-
-
-        fh.write('class ' + self.__class__.__name__ + ': public IonChannel{' + '\n')
-        fh.write('private:' + '\n')
-        # fh.write('    double m_g_bar = 0.0, m_e_rev = %.8f;\n'%e_rev)
-        for ind, varname in np.ndenumerate(self.varnames):
-                fh.write('    double m_' + sp.printing.ccode(varname) +';\n')
-        for ind, varname in np.ndenumerate(self.varnames):
-                fh.write('    double m_' + sp.printing.ccode(varname) + '_inf, m_tau_' + sp.printing.ccode(varname) + ';\n')
-        for ind, varname in np.ndenumerate(self.varnames):
-                fh.write('    double m_v_' + sp.printing.ccode(varname) + '= 10000.;\n')
-        fh.write('    double m_p_open_eq = 0.0, m_p_open = 0.0;\n')
-        fh.write('public:' + '\n')
-        fh.write('    void calcFunStatevar(double v) override;' + '\n')
-        fh.write('    double calcPOpen() override;' + '\n')
-        fh.write('    void setPOpen() override;' + '\n')
-        fh.write('    void setPOpenEQ(double v) override;' + '\n')
-        fh.write('    void advance(double dt) override;' + '\n')
-        fh.write('    double getCond() override;' + '\n')
-        fh.write('    double getCondNewton() override;' + '\n')
-        fh.write('    double f(double v) override;' + '\n')
-        fh.write('    double DfDv(double v) override;' + '\n')
-        fh.write('    void setfNewtonConstant(double* vs, int v_size) override;' + '\n')
-        fh.write('    double fNewton(double v) override;' + '\n')
-        fh.write('    double DfDvNewton(double v) override;' + '\n')
-        fh.write('};' + '\n')
-
-        fcc.write('void ' + self.__class__.__name__ + '::calcFunStatevar(double v){' + '\n')
-        for ind, varinf in np.ndenumerate(self.varinf):
-            tauinf = self.tauinf[ind]
-            varname = self.varnames[ind]
-            varinf_ = self._substituteConc(varinf)
-            tauinf_ = self._substituteConc(tauinf)
-            fcc.write('    m_' + sp.printing.ccode(varname) + '_inf = ' + sp.printing.ccode(varinf_) + ';' + '\n')
+        cname = self.__class__.__name__
+        # c code for the state variable names, and the symbols of the
+        # members substituted for the state variables, shared by all
+        # generated functions
+        cnames = {ind: _ccode(statevar) \
+                  for ind, statevar in np.ndenumerate(self.statevars)}
+        m_syms = {self.statevars[ind]: sp.Symbol(f'm_{name}') \
+                  for ind, name in cnames.items()}
+        m_inf_syms = {self.statevars[ind]: sp.Symbol(f'm_{name}_inf') \
+                      for ind, name in cnames.items()}
+        # state variables with voltage independent activations do not need
+        # a voltage for the Newton iteration, state variables with constant
+        # time scales reuse their propagator while `dt` does not change
+        varinfs_c = {ind: sp.sympify(self._substituteConc(self.varinf[ind])) \
+                     for ind in cnames}
+        tauinfs_c = {ind: sp.sympify(self._substituteConc(self.tauinf[ind])) \
+                     for ind in cnames}
+        v_dep = {ind: self.sp_v in varinf.free_symbols \
+                 for ind, varinf in varinfs_c.items()}
+        tau_const = {ind: self.sp_v not in tauinf.free_symbols and \
+                          not (self.varinf.shape[1] == 2 and ind == (0,0)) \
+                     for ind, tauinf in tauinfs_c.items()}
+
+        # hcode += '    double m_g_bar = 0.0, m_e_rev = %.8f;\n'%e_rev
+        members = ''.join(f'    double m_{name};\n' for name in cnames.values())
+        members += ''.join(f'    double m_{name}_inf, m_tau_{name};\n' \
+                           for name in cnames.values())
+        members += ''.join(f'    double m_v_{name}= 10000.;\n' \
+                           for ind, name in cnames.items() if v_dep[ind])
+        members += ''.join(f'    double m_{name}_newton, m_d{name}_dv_newton;\n' \
+                           f'    bool m_dyn_{name} = true;\n' \
+                           for ind, name in cnames.items() if v_dep[ind])
+        members += ''.join(f'    double m_p0_{name} = 0.;\n' \
+                           for ind, name in cnames.items() if tau_const[ind])
+
+        temps, varinfs, tauinfs = self._cseRates(
+            [self._substituteConc(varinf) for varinf in self.varinf.flat],
+            [self._substituteConc(tauinf) for tauinf in self.tauinf.flat])
+        calc_fun_statevar = ''.join(f'    double {symb} = {_ccode(expr)};\n' \
+                                    for symb, expr in temps)
+        for ind, varinf, tauinf in zip(cnames, varinfs, tauinfs):
+            name = cnames[ind]
+            varinf_ = _ccode(varinf)
+            tauinf_ = _ccode(tauinf)
+            calc_fun_statevar += f'    m_{name}_inf = {varinf_};\n'
             if self.varinf.shape[1] == 2 and ind == (0,0):
-                fcc.write('    if(m_instantaneous)' + '\n')
-                fcc.write('        m_tau_' + sp.printing.ccode(varname) + ' = ' + sp.printing.ccode(sp.Float(1e-5))  + ';\n')
-                fcc.write('    else' + '\n')
-                fcc.write('        m_tau_' + sp.printing.ccode(varname) + ' = ' + sp.printing.ccode(tauinf_) + ';\n')
+                calc_fun_statevar += '    if(m_instantaneous)\n' \
+                    f'        m_tau_{name} = {_ccode(sp.Float(1e-5))};\n' \
+                    '    else\n' \
+                    f'        m_tau_{name} = {tauinf_};\n'
             else:
-                fcc.write('    m_tau_' + sp.printing.ccode(varname) + ' = ' + sp.printing.ccode(tauinf_) + ';\n')
-        fcc.write('}' + '\n')
-
-        # fcc.write('void ' + self.__class__.__name__ + '::calcFunStatevarInstantaneousAct(double v){' + '\n')
-        # for ind, varinf in np.ndenumerate(self.varinf):
-        #     if self.varinf.shape[1] == 2 and ind == (0,0):
-        #         # instantaneous activation approximation
-        #         tauinf = sp.Float(1e-5)
-        #     else:
-        #         tauinf = self.tauinf[ind]
-        #     varname = self.varnames[ind]
-        #     varinf_ = self._substituteConc(varinf)
-        #     tauinf_ = self._substituteConc(tauinf)
-        #     fcc.write('    m_' + sp.printing.ccode(varname) + '_inf = ' + sp.printing.ccode(varinf_) + ';' + '\n')
-        #     fcc.write('    m_tau_' + sp.printing.ccode(varname) + ' = ' + sp.printing.ccode(tauinf_) + ';' + '\n')
-        # fcc.write('}' + '\n')
-
-        fcc.write('double ' + self.__class__.__name__ + '::calcPOpen(){' + '\n')
-        expr = copy.deepcopy(self.p_open)
-        for ind, varname in np.ndenumerate(self.varnames):
-            symb = sp.symbols('m_' + sp.printing.ccode(varname))
-            expr = expr.subs(varname, symb)
-        fcc.write('    return ' + sp.printing.ccode(expr) + ';' + '\n')
-        fcc.write('}' + '\n')
-
-        fcc.write('void ' + self.__class__.__name__ + '::setPOpen(){' + '\n')
-        fcc.write('    m_p_open = calcPOpen();' + '\n')
-        fcc.write('}' + '\n')
-
-        fcc.write('void ' + self.__class__.__name__ + '::setPOpenEQ(double v){' + '\n')
-        fcc.write('    calcFunStatevar(v);' + '\n')
-        fcc.write('')
-        expr = copy.deepcopy(self.p_open)
-        for ind, varname in np.ndenumerate(self.varnames):
-            symb = sp.symbols('m_' + sp.printing.ccode(varname) + '_inf')
-            expr = expr.subs(varname, symb)
-            fcc.write('    m_' + sp.printing.ccode(varname) + ' = ' + sp.printing.ccode(symb) + ';\n')
-        fcc.write('    m_p_open_eq =' + sp.printing.ccode(expr) + ';' + '\n')
-        fcc.write('}' + '\n')
-
-        fcc.write('void ' + self.__class__.__name__ + '::advance(double dt){' + '\n')
-        for ind, varinf in np.ndenumerate(self.varinf):
-            tauinf = self.tauinf[ind]
-            varname = 'm_' + sp.printing.ccode(self.varnames[ind])
-            varname_inf = 'm_' + sp.printing.ccode(self.varnames[ind]) + '_inf'
-            varname_tau = 'm_tau_' + sp.printing.ccode(self.varnames[ind])
-            propname = 'p0_' + sp.printing.ccode(self.varnames[ind])
-            # fcc.write('    ' + varname + ' += dt * (' + varname_inf + ' - ' + varname + ') / ' + varname_tau + ';' + '\n')
-            fcc.write('    double ' + propname + ' = exp(-dt / ' + varname_tau + ');\n')
-            fcc.write('    ' + varname + ' *= ' + propname + ' ;\n')
-            fcc.write('    ' + varname + ' += (1. - ' + propname + ' ) *  ' + varname_inf + ';\n')
-        fcc.write('}' + '\n')
-
-
-        # self.exp_aux = np.exp(-dt/self.tauinf_aux)
-        # # advance the variables
-        # self.sv *= self.exp_aux
-        # self.sv += (1.-self.exp_aux) * self.svinf_aux
-
-        fcc.write('double ' + self.__class__.__name__ + '::getCond(){' + '\n')
-        fcc.write('    return m_g_bar * (m_p_open - m_p_open_eq);' + '\n')
-        fcc.write('}' + '\n')
-
-        fcc.write('double ' + self.__class__.__name__ + '::getCondNewton(){' + '\n')
-        fcc.write('    return m_g_bar;' + '\n')
-        fcc.write('}' + '\n')
-
-        # function for temporal integration
-        fcc.write('double ' + self.__class__.__name__ + '::f(double v){' + '\n')
-        fcc.write('    return (m_e_rev - v);' + '\n')
-        fcc.write('}' + '\n')
-
-        fcc.write('double ' + self.__class__.__name__ + '::DfDv(double v){' + '\n')
-        fcc.write('    return -1.;' + '\n')
-        fcc.write('}' + '\n')
-
-        # set voltage values to evaluate at constant voltage during newton iteration
-        fcc.write('void ' + self.__class__.__name__ + '::setfNewtonConstant(double* vs, int v_size){' + '\n')
-        fcc.write('    if(v_size != %d)'%self.statevars.size + '\n')
-        fcc.write('        cerr << "input arg [vs] has incorrect size, ' + \
-                  'should have same size as number of channel state variables" << endl' + ';\n')
-        for ii, statevar in enumerate(np.nditer(self.statevars, flags=['refs_ok'])):
-            fcc.write('    m_v_' + sp.printing.ccode(statevar) + ' = vs[%d]'%ii + ';\n')
-        fcc.write('}' + '\n')
-
-        # functions for solving Newton iteration
-        fcc.write('double ' + self.__class__.__name__ + '::fNewton(double v){' + '\n')
-        p_o = self.p_open
-        for ind, varname in np.ndenumerate(self.varnames):
-            v_var = sp.symbols('v_' + str(varname))
-            # substitute voltage symbol in the activation
-            varinf_ = self._substituteConc(self.varinf[ind]).subs(self.sp_v, v_var)
-            # assign dynamic or fixed voltage to the activation
-            fcc.write('    double ' + sp.printing.ccode(v_var) + ';\n')
-            fcc.write('    if(m_' + sp.printing.ccode(v_var) + ' > 1000.){' + '\n')
-            fcc.write('        ' + sp.printing.ccode(v_var) + ' = v' + ';\n')
-            fcc.write('    } else{' + '\n')
-            fcc.write('        ' + sp.printing.ccode(v_var) + ' = m_' + sp.printing.ccode(v_var) + ';\n')
-            fcc.write('    }' + '\n')
-            fcc.write('    double ' + sp.printing.ccode(varname) + ' = ' + sp.printing.ccode(varinf_) + ';\n')
-            # p_o = p_o.subs(self.statevars[ind], varinf_)
-
-        fcc.write('    return (m_e_rev - v) * (' + sp.printing.ccode(p_o) + ' - m_p_open_eq)' + ';\n')
-        fcc.write('}' + '\n')
-
-        fcc.write('double ' + self.__class__.__name__ + '::DfDvNewton(double v){' + '\n')
-        p_o = self.p_open
-        # compute partial derivatives
-        dp_o = np.zeros_like(self.statevars)
-        for ind, var in np.ndenumerate(self.statevars):
-            dp_o[ind] = sp.diff(p_o, var, 1)
-        # print derivatives
-        for ind, varname in np.ndenumerate(self.varnames):
-            v_var = sp.symbols('v_' + str(varname))
-            # substitute voltage symbol in the activation
-            varinf_ = self._substituteConc(self.varinf[ind]).subs(self.sp_v, v_var)
-            dvarinf_dv = sp.diff(varinf_, v_var, 1)
-            # compute derivative
-            fcc.write('    double ' + sp.printing.ccode(v_var) + ';\n')
-            fcc.write('    double d' + sp.printing.ccode(varname) + '_dv;\n')
-            fcc.write('    if(m_' + sp.printing.ccode(v_var) + ' > 1000.){' + '\n')
-            fcc.write('        ' + sp.printing.ccode(v_var) + ' = v' + ';\n')
-            fcc.write('        d' + sp.printing.ccode(varname) + '_dv = ' + sp.printing.ccode(dvarinf_dv) + ';\n')
-            fcc.write('    } else{' + '\n')
-            fcc.write('        ' + sp.printing.ccode(v_var) + ' = m_' + sp.printing.ccode(v_var) + ';\n')
-            fcc.write('        d' + sp.printing.ccode(varname) + '_dv = 0;\n')
-            fcc.write('    }' + '\n')
-            fcc.write('    double ' + sp.printing.ccode(varname) + ' = ' + sp.printing.ccode(varinf_) + ';\n')
-
-            # subs
-            # p_o = p_o.subs(self.statevars[ind], varinf_)
-            # for ind_, _ in np.ndenumerate(self.varnames):
-            #     dp_o[ind_].subs(self.statevars[ind], varinf_)
-
-        expr_str = '+'.join([sp.printing.ccode(dp_o_) + ' * d' + sp.printing.ccode(self.varnames[ind]) + '_dv' for ind, dp_o_ in np.ndenumerate(dp_o)])
-
-        fcc.write('    return -1. * (' + sp.printing.ccode(p_o) + ' - m_p_open_eq) + (' + expr_str + ') * (m_e_rev - v)' + ';\n')
-        fcc.write('}' + '\n')
-
-
-
-
-        fh.write('\n')
-        fcc.write('\n')
-        # fstruct.write('    ' + self.__class__.__name__ + ' ' + self.__class__.__name__ + '_;' + '\n')
-
-        fh.close()
-        fcc.close()
-        # fstruct.close()
+                calc_fun_statevar += f'    m_tau_{name} = {tauinf_};\n'
+
+        p_open_temps, (p_open,) = _cse_ccode([self.p_open.xreplace(m_syms)],
+                                             sp.numbered_symbols('cse'))
+        p_open_eq_temps, (p_open_eq,) = _cse_ccode([self.p_open.xreplace(m_inf_syms)],
+                                                   sp.numbered_symbols('cse'))
+        # open probability for `n` sets of state variables, each state
+        # variable stored contiguously in a buffer from `allocBatch`. The
+        # alignment of these buffers is assumed, other buffers (e.g. the data
+        # of a `std::vector` or a numpy array) are undefined behaviour
+        batch_pointers = ''.join(f'    const double* __restrict__ x_{name} = ' \
+                                 f'(const double*)__builtin_assume_aligned(x[{ii}], 64);\n' \
+                                 for ii, name in enumerate(cnames.values()))
+        batch_statevars = ''.join(f'        double {name} = x_{name}[i];\n' \
+                                  for name in cnames.values())
+        p_open_batch_temps, (p_open_batch,) = _cse_ccode([self.p_open],
+            sp.numbered_symbols('cse'), indent=' '*8)
+        set_statevars_eq = ''.join(f'    m_{name} = m_{name}_inf;\n' \
+                                   for name in cnames.values())
+
+        # integrate the state variables exactly for constant voltage over
+        # `dt`, `expm1` is accurate for `dt` small compared to the time scale
+        # (`fastExpm1` is a cheaper version for the small arguments typical
+        # of the integration step).
+        # The propagators of the constant time scales are computed in
+        # `precomputeDt`, which is called again only when `dt` changes
+        precompute_dt = ''.join(
+            f'    m_p0_{name} = -expm1(-dt / {_ccode(tauinfs_c[ind])});\n' \
+            for ind, name in cnames.items() if tau_const[ind])
+        advance = '    if(dt != m_dt)\n' \
+                  '        precomputeDt(dt);\n' if len(precompute_dt) > 0 else ''
+        for ind, name in cnames.items():
+            if tau_const[ind]:
+                advance += f'    m_{name} = fma(m_p0_{name}, m_{name}_inf - m_{name}, m_{name});\n'
+            else:
+                advance += f'    double p0_{name} = -fastExpm1(-dt / m_tau_{name});\n' \
+                           f'    m_{name} = fma(p0_{name}, m_{name}_inf - m_{name}, m_{name});\n'
+
+        # functions for solving Newton iteration, the activations are
+        # evaluated at the dynamic or at a fixed voltage. Whether the voltage
+        # is fixed is decided once in `setfNewtonConstant`, which also
+        # evaluates the activations at the fixed voltages. The activations
+        # and their voltage derivatives at the dynamic voltage are evaluated
+        # once per voltage in `evalNewton`, and shared by `fNewton` and
+        # `DfDvNewton`
+        set_v_statevars, eval_newton = '', ''
+        newton_syms = {}
+        symbols = sp.numbered_symbols('cse')
+        for ii, (ind, name) in enumerate(cnames.items()):
+            if not v_dep[ind]:
+                # voltage independent activations are folded in
+                newton_syms[self.statevars[ind]] = varinfs_c[ind]
+                continue
+            newton_syms[self.statevars[ind]] = sp.Symbol(f'm_{name}_newton')
+            varinf_ = varinfs_c[ind]
+            dvarinf_dv = sp.diff(varinf_, self.sp_v, 1)
+            temps_fix, (cvarinf_fix,) = _cse_ccode(
+                [varinf_.xreplace({self.sp_v: sp.Symbol(f'm_v_{name}')})],
+                symbols, indent=' '*8)
+            set_v_statevars += f'    m_v_{name} = vs[{ii}];\n' \
+                               f'    m_dyn_{name} = m_v_{name} > 1000.;\n' \
+                               f'    if(!m_dyn_{name}){{\n' \
+                               f'{temps_fix}' \
+                               f'        m_{name}_newton = {cvarinf_fix};\n' \
+                               f'        m_d{name}_dv_newton = 0.;\n' \
+                               '    }\n'
+            temps_dyn, (cvarinf_dyn, cdvarinf_dv) = _cse_ccode(
+                [varinf_, dvarinf_dv], symbols, indent=' '*8)
+            eval_newton += f'    if(m_dyn_{name}){{\n' \
+                           f'{temps_dyn}' \
+                           f'        m_{name}_newton = {cvarinf_dyn};\n' \
+                           f'        m_d{name}_dv_newton = {cdvarinf_dv};\n' \
+                           '    }\n'
+        p_o = self.p_open.xreplace(newton_syms)
+        # partial derivatives to the voltage dependent state variables
+        inds = [ind for ind in cnames if v_dep[ind]]
+        dp_o = [dp_o_.xreplace(newton_syms) for dp_o_ in sp.Matrix(
+            [self.p_open]).jacobian([self.statevars[ind] for ind in inds])] \
+               if len(inds) > 0 else []
+        f_newton, (p_newton,) = _cse_ccode([p_o], sp.numbered_symbols('cse'))
+        dfdv_newton, (dfdv_p_newton, *dp_newton) = _cse_ccode(
+            [p_o] + dp_o, sp.numbered_symbols('cse'))
+        dp_newton = '+'.join([f'{dp_o_} * m_d{cnames[ind]}_dv_newton' \
+                              for ind, dp_o_ in zip(inds, dp_newton)])
+        if len(dp_newton) == 0:
+            dp_newton = '0.'
+
+        hcode = _H_TEMPLATE.format(cname=cname, members=members)
+        cccode = _CC_TEMPLATE.format(
+            cname=cname,
+            calc_fun_statevar=calc_fun_statevar,
+            p_open_temps=p_open_temps,
+            p_open=p_open,
+            batch_pointers=batch_pointers,
+            batch_statevars=batch_statevars,
+            p_open_batch_temps=p_open_batch_temps,
+            p_open_batch=p_open_batch,
+            set_statevars_eq=set_statevars_eq,
+            p_open_eq_temps=p_open_eq_temps,
+            p_open_eq=p_open_eq,
+            precompute_dt=precompute_dt,
+            advance=advance,
+            n_statevar=self.statevars.size,
+            set_v_statevars=set_v_statevars,
+            eval_newton=eval_newton,
+            f_newton=f_newton,
+            dfdv_newton=dfdv_newton,
+            p_newton=p_newton,
+            dfdv_p_newton=dfdv_p_newton,
+            dp_newton=dp_newton,
+        )
+
+        with open(os.path.join(path, 'Ionchannels.h'), 'a', buffering=1<<20) as fh:
+            fh.write(hcode)
+        with open(os.path.join(path, 'Ionchannels.cc'), 'a', buffering=1<<20) as fcc:
+            fcc.write(cccode)
 
 
     # def computeLin(self, v):
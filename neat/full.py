@@ -0,0 +1,17 @@
+"""
+Eager import of the full public API of `neat`, e.g. for interactive use:
+
+    >>> from neat.full import *
+
+`import neat` on its own only imports a module when one of its names is first
+accessed.
+
+Author: W. Wybo
+"""
+
+import neat as _neat
+
+_neat._loadAll()
+
+__all__ = list(_neat.__all__)
+globals().update({name: getattr(_neat, name) for name in __all__})
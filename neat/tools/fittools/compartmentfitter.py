@@ -2,8 +2,12 @@ import concurrent.futures
 import contextlib
 import multiprocessing
 import numpy as np
+import scipy.linalg as la
 import warnings
+import logging
 
+from ..._mpl import ensureAgg
+ensureAgg()
 import matplotlib.patheffects as patheffects
 import matplotlib.patches as patches
 import matplotlib.cm as cm
@@ -24,7 +28,7 @@ from ...tools import kernelextraction as ke
 try:
     from ...tools.simtools.neuron import neuronmodel as neurm
 except ModuleNotFoundError:
-    warnings.warn('NEURON not available', UserWarning)
+    logging.getLogger(__name__).info('NEURON not available')
    
 import warnings
 import copy
@@ -1297,8 +1301,11 @@ class CompartmentFitter(object):
             a_mat = np.concatenate((a_mat, a_mat_), axis=0)
             b_vec = np.concatenate((b_vec, b_vec_), axis=0)
 
-        # compute rescaled synaptic conductances
-        g_resc = np.linalg.lstsq(a_mat, b_vec, rcond=None)[0]
+        # compute rescaled synaptic conductances, with a QR based solver and
+        # the same rank cutoff as `np.linalg.lstsq`
+        g_resc = la.lstsq(a_mat, b_vec,
+                          cond=np.finfo(float).eps * max(a_mat.shape),
+                          lapack_driver='gelsy', check_finite=False)[0]
 
         b_arr = g_syns > 1e-9
         g_resc[np.logical_not(b_arr)] = 1.
@@ -15,6 +15,7 @@ from scipy.cluster.vq import kmeans
 import math
 import copy
 
+from .._mpl import ensureAgg
 
 
 class Fitter(object):
@@ -639,6 +640,7 @@ class fExpFitter(Fitter):
             amin = np.min(a[inds])
             EF = ExpFitter()
             if pplot == True:
+                ensureAgg()
                 import matplotlib.pyplot as pl
                 y_f_full = self.sumFExp(s, a, c)
                 y_f_part = self.sumFExp(s, a[inds], c[inds])
@@ -744,6 +746,7 @@ class fExpFitter(Fitter):
                 print('integral fit reduced: ', - np.sum(C * (np.exp(-A*t[-1]) - np.exp(-A*t[0])) / A))
                 print('final a\'s :', anew)
                 print('new a\'s :', A)
+                ensureAgg()
                 import matplotlib.pyplot as pl
                 pl.figure('reduce_exp problem')
                 pl.plot(t*1000, se, 'r', label='original kernel')
@@ -1122,6 +1125,10 @@ class FourrierTools(object):
         return self.t, tarr
 
 
+# correctly spelled alias
+FourierTools = FourrierTools
+
+
 class expExtractor(object):
     def __call__(self, N=1, recalc=False, atol=5e-2, pprint=True):
         """
@@ -6,6 +6,7 @@ import numpy as np
 
 from ....trees.morphtree import MorphLoc
 from ....trees.phystree import PhysTree, PhysNode
+from ...._mpl import ensureAgg
 
 import neuron
 from neuron import h
@@ -750,6 +751,7 @@ class NeuronSimTree(PhysTree):
                 # compute impedances
                 z_mat[ii, jj] = v_trans / i_amp
                 if pplot:
+                    ensureAgg()
                     import matplotlib.pyplot as pl
                     pl.figure()
                     pl.plot(res['t'], res['v_m'][1])
@@ -11,17 +11,105 @@ Author: W. Wybo
 import numpy as np
 import scipy.linalg as la
 import scipy.optimize as so
+import scipy.sparse as sparse
 import sympy as sp
 
 from .stree import SNode, STree
-from ..channels import channelcollection
+from .._mpl import ensureAgg
+from ..channels import channelcollection, concmechs
 from ..tools import kernelextraction as ke
 
 import copy
 import warnings
 import itertools
 from operator import mul
-from functools import reduce
+from functools import reduce, lru_cache
+
+try:
+    import numba
+except ModuleNotFoundError:
+    numba = None
+
+
+def _linearRecursion(a, b, x0):
+    """
+    Evaluates `x[:,t] = a[:,t-1] * x[:,t-1] + b[:,t-1]` along the second axis,
+    starting from `x[:,0] = x0`.
+    """
+    x = np.empty((a.shape[0], a.shape[1]+1))
+    x[:,0] = x0
+    for tt in range(1, x.shape[1]):
+        x[:,tt] = a[:,tt-1] * x[:,tt-1] + b[:,tt-1]
+    return x
+
+if numba is not None:
+    _linearRecursion = numba.njit(cache=True)(_linearRecursion)
+
+
+def _nnls(mat, vec):
+    """
+    Non-negative least squares solution of `mat @ x = vec`, with the same
+    return values as `scipy.optimize.nnls`.
+
+    For overdetermined real systems, the problem is first reduced to the
+    triangular factor of the QR decomposition of `[mat, vec]`, which has the
+    same solution, so that the active set iterations act on a square system
+    instead of on the full feature matrix.
+    """
+    n_row, n_col = mat.shape
+    if n_row <= n_col or np.iscomplexobj(mat) or np.iscomplexobj(vec):
+        return so.nnls(mat, vec)
+    r_aug = la.qr(np.column_stack((mat, vec)), mode='r',
+                  overwrite_a=True, check_finite=False)[0]
+    # the active set iterations always run in double precision
+    r_aug = r_aug.astype(np.float64, copy=False)
+    x, r_norm = so.nnls(r_aug[:n_col,:n_col], r_aug[:n_col,n_col])
+    # add the part of `vec` outside of the column space of `mat`
+    return x, np.sqrt(r_norm**2 + r_aug[n_col,n_col]**2)
+
+
+def _asPrecision(arr, dtype):
+    """
+    Cast `arr` to the floating point precision of `dtype`, keeping complex
+    arrays complex.
+    """
+    if np.iscomplexobj(arr):
+        dtype = np.result_type(dtype, np.complex64)
+    return np.asarray(arr).astype(dtype, copy=False)
+
+
+def _modeConvolution(p0, p1, p2, p_, phimat_inv, inputs, out):
+    """
+    Convolves the `inputs` (indices kct) with the eigenmodes of the passive
+    system, as the recurrence
+    `x[t] = p0 * x[t-1] + p1 * u[t] + p2 * u[t-1]` in each mode, with
+    `u[t] = phimat_inv[n,k] * inputs[k,c,t]`, and writes the result in `out`
+    (indices nkct).
+    """
+    n_k, n_c, n_t = inputs.shape
+    for nn in range(p0.shape[0]):
+        for kk in range(n_k):
+            a = phimat_inv[nn,kk]
+            for cc in range(n_c):
+                u_prev = a * inputs[kk,cc,0]
+                x = p_[nn] * u_prev
+                out[nn,kk,cc,0] = x
+                for tt in range(1, n_t):
+                    u = a * inputs[kk,cc,tt]
+                    x = p0[nn] * x + p1[nn] * u + p2[nn] * u_prev
+                    out[nn,kk,cc,tt] = x
+                    u_prev = u
+
+if numba is not None:
+    _modeConvolution = numba.njit(cache=True)(_modeConvolution)
+
+
+@lru_cache(maxsize=None)
+def _getChannelClass(channel_name):
+    """
+    Returns the class of the channel with the given name in `channelcollection`
+    """
+    return getattr(channelcollection, channel_name)
 
 
 class CompartmentNode(SNode):
@@ -219,8 +307,10 @@ class CompartmentNode(SNode):
         if channel_names is None: channel_names = list(self.currents.keys())
         if v is None: v = self.e_eq
 
-        conc_write_channels = np.zeros_like(freqs)
-        conc_read_channels  = np.zeros_like(freqs)
+        # accumulate in floating point, also for integer frequencies
+        dtype = np.result_type(freqs, float)
+        conc_write_channels = np.zeros(np.shape(freqs), dtype=dtype)
+        conc_read_channels  = np.zeros(np.shape(freqs), dtype=dtype)
         for channel_name, (g, e) in self.currents.items():
             if channel_name in channel_names and channel_name != 'L':
                 channel = channel_storage[channel_name]
@@ -346,33 +436,22 @@ class CompartmentNode(SNode):
         if channel_storage is not None:
             channel = channel_storage[channel_name]
         else:
-            channel = eval('channelcollection.' + channel_name + '()')
-        # storage
-        p_open = np.zeros_like(v)
-        # initialize
-        sv_inf_prev = channel.computeVarInf(v[0])
-        tau_prev = channel.computeTauInf(v[0])
-        sv = sv_inf_prev
-        p_open[0] = channel.computePOpen(v[0], statevars=sv)
-        for tt in range(1,len(v)):
-            sv_inf = channel.computeVarInf(v[tt])
-            tau = channel.computeTauInf(v[tt])
-            # sv_inf_aux = (sv_inf + sv_inf_prev) / 2.
-            f_aux  = -2. / (tau + tau_prev)
-            h_prev = sv_inf_prev / tau_prev
-            h_now  = sv_inf / tau
-            # sv[:,:,tt] = (sv[:,:,tt-1] + dt * sv_inf_aux / tau_aux) / (1. + dt / tau_aux)
-            p0_aux = np.exp(f_aux * dt)
-            p1_aux = (1. - p0_aux) / (f_aux**2 * dt)
-            p2_aux = p0_aux / f_aux + p1_aux
-            p3_aux = -1. / f_aux - p1_aux
-            # next step sv
-            sv = p0_aux * sv + p2_aux * h_prev + p3_aux * h_now
-            # store for next step
-            sv_inf_prev = sv_inf
-            tau_prev = tau
-            # store open probability
-            p_open[tt] = channel.computePOpen(v[tt], statevars=sv)
+            channel = _getChannelClass(channel_name)()
+        # activations and time scales along the full trace, one call each
+        sv_inf = channel.computeVarInf(v).reshape(-1, len(v))
+        tau = channel.computeTauInf(v).reshape(-1, len(v))
+        # integration coefficients for all time steps at once
+        f_aux  = -2. / (tau[:,1:] + tau[:,:-1])
+        h_aux = sv_inf / tau
+        p0_aux = np.exp(f_aux * dt)
+        p1_aux = (1. - p0_aux) / (f_aux**2 * dt)
+        p2_aux = p0_aux / f_aux + p1_aux
+        p3_aux = -1. / f_aux - p1_aux
+        # state variables along the trace, initialized at steady state
+        sv = _linearRecursion(p0_aux, p2_aux * h_aux[:,:-1] + p3_aux * h_aux[:,1:],
+                              sv_inf[:,0])
+        p_open = channel.computePOpen(v,
+                    statevars=sv.reshape(channel.varnames.shape + v.shape))
 
         return p_open * (v - e)
 
@@ -391,6 +470,14 @@ class CompartmentTree(STree):
     def __init__(self, root=None):
         super(CompartmentTree, self).__init__(root=root)
         self.channel_storage = {}
+        # cached coupling matrix, with the topology and coupling conductances
+        # it was constructed for
+        self._coupling_key = None
+        self._coupling_mat = None
+        # cached permutation from tree to location order, with the location
+        # indices it was computed for
+        self._perm_key = None
+        self._perm_locs = None
         # for fitting the model
         self.resetFitData()
 
@@ -461,18 +548,23 @@ class CompartmentTree(STree):
         """
         warnings.warn("This function will cause problems with new-style ion channels")
 
-        to_tree_inds = self._permuteToTreeInds()
+        nodes = list(self)
+        to_tree_inds = None
         for channel_name, expansion_point in expansion_points.items():
-            # if one set of state variables, set throughout neuron
-            if isinstance(expansion_point, str) or \
-               expansion_point is None:
-                svs = np.array([expansion_point for _ in self])
-            elif isinstance(expansion_point, np.ndarray):
-                if expansion_point.ndim == 3:
-                    svs = np.array(expansion_point)
-                elif expansion_point.ndim == 2:
-                    svs = np.array([expansion_point for _ in self])
-            for node, sv in zip(self, svs[to_tree_inds]):
+            if isinstance(expansion_point, np.ndarray) and \
+               expansion_point.ndim == 3:
+                # one set of state variables per location
+                if to_tree_inds is None:
+                    to_tree_inds = self._permuteToTreeInds()
+                svs = expansion_point[to_tree_inds]
+            else:
+                # if one set of state variables, set throughout neuron, arrays
+                # are shared between nodes as read-only views
+                if isinstance(expansion_point, np.ndarray):
+                    expansion_point = np.broadcast_to(expansion_point,
+                                                      expansion_point.shape)
+                svs = itertools.repeat(expansion_point)
+            for node, sv in zip(nodes, svs):
                 node.setExpansionPoint(channel_name, statevar=sv)
 
     def removeExpansionPoints(self):
@@ -484,36 +576,100 @@ class CompartmentTree(STree):
         Fit the leak reversal potential to obtain the stored equilibirum potentials
         as resting membrane potential
         """
-        e_l_0 = self.getEEq(indexing='tree')
-        # compute the solutions
+        nodes = list(self)
+        e_l_0 = np.array([node.e_eq for node in nodes])
+        # compute the solutions, the jacobian is diagonal
         fun = self._fun(e_l_0)
         jac = self._jac(e_l_0)
-        e_l = np.linalg.solve(jac, -fun + np.dot(jac, e_l_0))
+        e_l = e_l_0 - fun / jac
         # set the leak reversals
-        for ii, node in enumerate(self):
-            node.currents['L'][1] = e_l[ii]
+        for node, e_l_ in zip(nodes, e_l):
+            node.currents['L'][1] = e_l_
 
     def _fun(self, e_l):
-        # set the leak reversal potentials
-        for ii, node in enumerate(self):
-            node.currents['L'][1] = e_l[ii]
+        arrs = self._nodeArrays()
+        # set the leak reversal potentials, in the nodes and in the gathered
+        # arrays
+        for node, e in zip(arrs['nodes'], e_l):
+            node.currents['L'][1] = e
+        arrs['currents']['L'][1] = e_l
         # compute the function values (currents)
-        fun_vals = np.zeros(len(self))
-        for ii, node in enumerate(self):
-            fun_vals[ii] += node.getITot(self.channel_storage)
-            # add the parent node coupling term
-            if node.parent_node is not None:
-                fun_vals[ii] += node.g_c * (node.e_eq - node.parent_node.e_eq)
-            # add the child node coupling terms
-            for cnode in node.child_nodes:
-                fun_vals[ii] += cnode.g_c * (node.e_eq - cnode.e_eq)
+        fun_vals = self._calcITot(arrs=arrs)
+        # add the coupling terms, with the children and with the parent
+        ii = np.where(arrs['parent'] >= 0)[0]
+        jj = arrs['parent'][ii]
+        i_c = arrs['g_c'][ii] * (arrs['e_eq'][ii] - arrs['e_eq'][jj])
+        fun_vals[ii] += i_c
+        # parents can have multiple children
+        fun_vals -= np.bincount(jj, weights=i_c, minlength=len(fun_vals))
         return fun_vals
 
+    def _calcITot(self, arrs=None):
+        """
+        Compute the total current of all channels at the equilibrium
+        potentials of all nodes, with each channel evaluated at all nodes at
+        once (see `CompartmentNode.getITot`)
+
+        Parameters
+        ----------
+        arrs: dict, optional
+            The node parameters as returned by `self._nodeArrays()`
+
+        Returns
+        -------
+        `np.ndarray` (``ndim = 1``)
+            the total currents, in iteration order of the nodes
+        """
+        if arrs is None: arrs = self._nodeArrays()
+        v = arrs['e_eq']
+
+        g_l, e_l = arrs['currents']['L']
+        i_tot = g_l * (v - e_l)
+        for channel_name, (g, e) in arrs['currents'].items():
+            if channel_name != 'L':
+                channel = self.channel_storage[channel_name]
+                sv = self._stackExpansionPoints(channel_name, arrs)
+                i_tot += g * channel.computePOpen(v, statevars=sv) * (v - e)
+
+        return i_tot
+
+    def _calcGTot(self, arrs=None):
+        """
+        Compute the total conductance of all channels at the equilibrium
+        potentials of all nodes, with each channel evaluated at all nodes at
+        once (see `CompartmentNode.getGTot`)
+
+        Parameters
+        ----------
+        arrs: dict, optional
+            The node parameters as returned by `self._nodeArrays()`
+
+        Returns
+        -------
+        `np.ndarray` (``ndim = 1``)
+            the total conductances, in iteration order of the nodes
+        """
+        if arrs is None: arrs = self._nodeArrays()
+        v = arrs['e_eq']
+
+        g_tot = np.array(arrs['currents']['L'][0])
+        for channel_name, (g, _) in arrs['currents'].items():
+            if channel_name != 'L':
+                channel = self.channel_storage[channel_name]
+                sv = self._stackExpansionPoints(channel_name, arrs)
+                g_tot += g * channel.computePOpen(v, statevars=sv)
+
+        return g_tot
+
     def _jac(self, e_l):
+        """
+        Diagonal of the jacobian of `self._fun`
+        """
+        jac_vals = np.zeros(len(e_l))
         for ii, node in enumerate(self):
             node.currents['L'][1] = e_l[ii]
-        jac_vals = np.array([-node.currents['L'][0] for node in self])
-        return np.diag(jac_vals)
+            jac_vals[ii] = -node.currents['L'][0]
+        return jac_vals
 
     def addCurrent(self, channel, e_rev):
         """
@@ -545,34 +701,60 @@ class CompartmentTree(STree):
         """
         for node in self: node.addConcMech(ion, params=params)
 
-    def _permuteToTreeInds(self):
-        return np.array([node.loc_ind for node in self])
+    def _permuteToTreeInds(self, arrs=None):
+        """
+        give index list that can be used to permutate the axes of matrices in
+        the order of the associated set of locations to the tree order
+
+        Parameters
+        ----------
+        arrs: dict, optional
+            The node parameters as returned by `self._nodeArrays()`, avoids
+            a traversal of the tree
+        """
+        if arrs is None or np.any(arrs['loc_ind'] < 0):
+            # accessing `node.loc_ind` raises if it is undefined
+            return np.array([node.loc_ind for node in self], dtype=int)
+        return arrs['loc_ind']
 
-    def _permuteToTree(self, mat):
-        index_arr = self._permuteToTreeInds()
+    def _permuteToTree(self, mat, arrs=None):
+        index_arr = self._permuteToTreeInds(arrs=arrs)
         if mat.ndim == 1:
             return mat[index_arr]
         elif mat.ndim == 2:
-            return mat[index_arr,:][:,index_arr]
+            return mat[np.ix_(index_arr, index_arr)]
         elif mat.ndim == 3:
-            return mat[:,index_arr,:][:,:,index_arr]
+            return mat[:,index_arr[:,None],index_arr[None,:]]
 
-    def _permuteToLocsInds(self):
+    def _permuteToLocsInds(self, arrs=None):
         """
         give index list that can be used to permutate the axes of the impedance
-        and system matrix to correspond to the associated set of locations
-        """
-        loc_inds = np.array([node.loc_ind for node in self])
-        return np.argsort(loc_inds)
+        and system matrix to correspond to the associated set of locations.
+        The permutation is cached, and only recomputed when the location
+        indices of the nodes have changed.
 
-    def _permuteToLocs(self, mat):
-        index_arr = self._permuteToLocsInds()
+        Parameters
+        ----------
+        arrs: dict, optional
+            The node parameters as returned by `self._nodeArrays()`, avoids
+            a traversal of the tree
+        """
+        loc_inds = self._permuteToTreeInds(arrs=arrs)
+        if self._perm_key is None or \
+           not np.array_equal(self._perm_key, loc_inds):
+            self._perm_key = np.array(loc_inds)
+            self._perm_locs = np.argsort(loc_inds)
+            self._perm_locs.flags.writeable = False
+        return self._perm_locs
+
+    def _permuteToLocs(self, mat, arrs=None):
+        index_arr = self._permuteToLocsInds(arrs=arrs)
         if mat.ndim == 1:
             return mat[index_arr]
         elif mat.ndim == 2:
-            return mat[index_arr,:][:,index_arr]
+            return mat[np.ix_(index_arr, index_arr)]
         elif mat.ndim == 3:
-            return mat[:,index_arr,:][:,:,index_arr]
+            return mat[:,index_arr[:,None],index_arr[None,:]]
 
     def getEquivalentLocs(self):
         """
@@ -584,8 +766,7 @@ class CompartmentTree(STree):
         list of tuple
             Tuple has the form `(node.index, .5)`
         """
-        loc_inds = [node.loc_ind for node in self]
-        index_arr = np.argsort(loc_inds)
+        index_arr = self._permuteToLocsInds()
         locs_unordered = [(node.index, .5) for node in self]
         return [locs_unordered[ind] for ind in index_arr]
 
@@ -630,23 +811,228 @@ class CompartmentTree(STree):
         `np.ndarray` (``dtype = float``, ``ndim = 2``)
             the conductance matrix
         """
-        g_mat = np.zeros((len(self), len(self)))
-        for node in self:
-            ii = node.index
-            g_mat[ii, ii] += node.getGTot(self.channel_storage) + node.g_c
-            if node.parent_node is not None:
-                jj = node.parent_node.index
-                g_mat[jj,jj] += node.g_c
-                g_mat[ii,jj] -= node.g_c
-                g_mat[jj,ii] -= node.g_c
+        arrs = self._nodeArrays()
+        inds = arrs['index']
+        g_mat = np.array(self._calcCouplingMatrix(arrs=arrs))
+        g_mat[inds,inds] += self._calcGTot(arrs=arrs)
         if indexing == 'locs':
-            return self._permuteToLocs(g_mat)
+            return self._permuteToLocs(g_mat, arrs=arrs)
         elif indexing == 'tree':
             return g_mat
         else:
             raise ValueError('invalid argument for `indexing`, ' + \
                              'has to be \'tree\' or \'locs\'')
 
+    def _nodeArrays(self):
+        """
+        Gather the parameters of all nodes in contiguous arrays, in the
+        iteration order of the nodes, with a single traversal of the tree
+
+        Returns
+        -------
+        dict
+            'nodes': list of `CompartmentNode`
+                the nodes
+            'index': `np.ndarray` of int
+                the node indices
+            'loc_ind': `np.ndarray` of int
+                the location indices of the nodes, -1 where undefined
+            'parent': `np.ndarray` of int
+                the iteration position of the parent of each node, -1 for
+                the root
+            'ca', 'g_c', 'e_eq': `np.ndarray` of float
+                the capacitances, coupling conductances and equilibrium
+                potentials
+            'currents': dict {str: `np.ndarray`}
+                for each current present at any of the nodes, the conductances
+                and reversals of all nodes stacked in an array of shape
+                ``(2, len(nodes))``, zero at nodes without the current
+        """
+        nodes = list(self)
+        position = {node.index: ii for ii, node in enumerate(nodes)}
+        # union of the currents of all nodes, in order of first occurence
+        channel_names = list(dict.fromkeys(channel_name for node in nodes \
+                                           for channel_name in node.currents))
+        return {
+            'nodes': nodes,
+            'index': np.array([node.index for node in nodes], dtype=int),
+            'loc_ind': np.array([-1 if node._loc_ind is None else \
+                                 node._loc_ind for node in nodes], dtype=int),
+            'parent': np.array([-1 if node.parent_node is None else \
+                                position[node.parent_node.index] \
+                                for node in nodes], dtype=int),
+            'ca': np.array([node.ca for node in nodes], dtype=float),
+            'g_c': np.array([node.g_c for node in nodes], dtype=float),
+            'e_eq': np.array([node.e_eq for node in nodes], dtype=float),
+            'currents': {channel_name: np.array(
+                    [node.currents.get(channel_name, (0., 0.)) \
+                     for node in nodes],
+                    dtype=float).reshape(-1, 2).T \
+                for channel_name in channel_names},
+        }
+
+    def _calcCouplingMatrix(self, arrs=None):
+        """
+        Constructs the matrix of the coupling conductances between the
+        compartments, in the order of the tree indices. The matrix is cached,
+        and only reconstructed when the topology or the coupling conductances
+        have changed.
+
+        Parameters
+        ----------
+        arrs: dict, optional
+            The node parameters as returned by `self._nodeArrays()`
+
+        Returns
+        -------
+        `np.ndarray` (``dtype = float``, ``ndim = 2``)
+            the coupling matrix, read-only
+        """
+        if arrs is None: arrs = self._nodeArrays()
+        key = (arrs['index'], arrs['parent'], arrs['g_c'])
+        if self._coupling_key is not None and \
+           all(np.array_equal(k0, k1) for k0, k1 in zip(key, self._coupling_key)):
+            return self._coupling_mat
+
+        inds, g_c = arrs['index'], arrs['g_c']
+        # the coupling of each node with its parent
+        edges = np.where(arrs['parent'] >= 0)[0]
+        ii, jj, g_e = inds[edges], inds[arrs['parent'][edges]], g_c[edges]
+
+        g_mat = np.zeros((len(inds), len(inds)))
+        g_mat[inds,inds] += g_c
+        # parents can have multiple children
+        np.add.at(g_mat, (jj, jj), g_e)
+        g_mat[ii,jj] -= g_e
+        g_mat[jj,ii] -= g_e
+        g_mat.flags.writeable = False
+
+        self._coupling_key, self._coupling_mat = key, g_mat
+        return g_mat
+
+    def _stackExpansionPoints(self, channel_name, arrs):
+        """
+        The expansion points of a channel at all nodes, stacked along a
+        trailing node axis. Nodes without expansion point contribute the
+        asymptotic state variables at their equilibrium potential.
+
+        Parameters
+        ----------
+        channel_name: str
+            The name of the channel
+        arrs: dict
+            The node parameters as returned by `self._nodeArrays()`
+
+        Returns
+        -------
+        `np.ndarray` or ``None``
+            ``None`` if none of the nodes has an expansion point
+        """
+        svs = [node.getExpansionPoint(channel_name) for node in arrs['nodes']]
+        if all(sv is None for sv in svs):
+            return None
+        channel = self.channel_storage[channel_name]
+        return np.stack([channel.computeVarInf(v) if sv is None else sv \
+                         for sv, v in zip(svs, arrs['e_eq'])], axis=-1)
+
+    def _calcMembraneConductanceTerms(self, freqs, channel_names, arrs=None):
+        """
+        Contributions of the linearized ion channels to the conductance
+        matrix, evaluated at all nodes at once (see
+        `CompartmentNode.calcMembraneConductanceTerms`)
+
+        Parameters
+        ----------
+        freqs: np.ndarray (ndim = 1, dtype = complex or float)
+            The frequencies at which the impedance terms are to be evaluated
+        channel_names: list of str
+            The names of the ion channels that have to be included in the
+            conductance term
+        arrs: dict, optional
+            The node parameters as returned by `self._nodeArrays()`
+
+        Returns
+        -------
+        tuple of str
+            The names of the channels, without duplicates, in the order in
+            which they occur in `channel_names`
+        np.ndarray (ndim = 3)
+            The conductance terms, the first axis is the channel, the second
+            axis the frequency and the third axis the node, in iteration order
+        """
+        if arrs is None: arrs = self._nodeArrays()
+        v = arrs['e_eq']
+
+        names = tuple(dict.fromkeys(channel_names))
+        cond_terms = np.empty((len(names), len(freqs), len(v)),
+                              dtype=np.result_type(freqs, float))
+        for ic, channel_name in enumerate(names):
+            if channel_name == 'L':
+                cond_terms[ic] = 1.
+                continue
+            channel = self.channel_storage[channel_name]
+            e = arrs['currents'][channel_name][1]
+            sv = self._stackExpansionPoints(channel_name, arrs)
+            # voltages along the first axis broadcast against the frequencies
+            lin_sum = channel.computeLinSum(v[:,None], freqs, e[:,None],
+                            statevars=None if sv is None else sv[...,None])
+            cond_terms[ic] = - lin_sum.T
+
+        return names, cond_terms
+
+    def _calcMembraneConcentrationTerms(self, ion, freqs, channel_names=None,
+                                              arrs=None):
+        """
+        Contributions of the linearized concentration dependence to the
+        conductance matrix, evaluated at all nodes at once (see
+        `CompartmentNode.calcMembraneConcentrationTerms`)
+
+        Parameters
+        ----------
+        ion: str
+            The ion for which the concentration terms are to be calculated
+        freqs: np.ndarray (ndim = 1, dtype = complex or float)
+            The frequencies at which the impedance terms are to be evaluated
+        channel_names: list of str
+            The names of the ion channels that have to be included in the
+            conductance term
+        arrs: dict, optional
+            The node parameters as returned by `self._nodeArrays()`
+
+        Returns
+        -------
+        np.ndarray (ndim = 2)
+            The concentration terms, the first axis is the frequency and the
+            second axis the node, in iteration order
+        """
+        if arrs is None: arrs = self._nodeArrays()
+        if channel_names is None: channel_names = list(arrs['currents'])
+        v = arrs['e_eq']
+
+        dtype = np.result_type(freqs, float)
+        conc_write_channels = np.zeros((len(v), len(freqs)), dtype=dtype)
+        conc_read_channels  = np.zeros((len(v), len(freqs)), dtype=dtype)
+        for channel_name, (g, e) in arrs['currents'].items():
+            if channel_name in channel_names and channel_name != 'L':
+                channel = self.channel_storage[channel_name]
+                sv = self._stackExpansionPoints(channel_name, arrs)
+                sv = None if sv is None else sv[...,None]
+                # if the channel adds to ion channel current, add it here
+                if channel.ion == ion:
+                    conc_write_channels += g[:,None] * \
+                        channel.computeLinSum(v[:,None], freqs, e[:,None],
+                                              statevars=sv)
+                # if channel reads the ion channel current, add it here
+                if ion in channel.concentrations:
+                    conc_read_channels -= g[:,None] * \
+                        channel.computeLinConc(v[:,None], freqs, e[:,None], ion,
+                                               statevars=sv)
+        # the concentration mechanisms can differ between nodes
+        conc_lin = np.array([node.concmechs[ion].computeLin(freqs) \
+                             for node in arrs['nodes']])
+
+        return (conc_write_channels * conc_read_channels * conc_lin).T
+
     def calcSystemMatrix(self, freqs=0., channel_names=None,
                                with_ca=True, use_conc=False,
                                indexing='locs'):
@@ -686,52 +1072,64 @@ class CompartmentTree(STree):
         if channel_names is None:
             channel_names = ['L'] + list(self.channel_storage.keys())
 
-        s_mat = np.zeros((len(freqs), len(self), len(self)), dtype=freqs.dtype)
-        for node in self:
-            ii = node.index
-            # set the capacitance contribution
-            if with_ca: s_mat[:,ii,ii] += freqs * node.ca
-            # set the coupling conductances
-            s_mat[:,ii,ii] += node.g_c
-            if node.parent_node is not None:
-                jj = node.parent_node.index
-                s_mat[:,jj,jj] += node.g_c
-                s_mat[:,ii,jj] -= node.g_c
-                s_mat[:,jj,ii] -= node.g_c
-            # set the ion channel contributions
-            g_terms = node.calcMembraneConductanceTerms(self.channel_storage,
-                            freqs=freqs, channel_names=channel_names)
-            s_mat[:,ii,ii] += sum([node.currents[c_name][0] * g_term \
-                                   for c_name, g_term in g_terms.items()])
-            if use_conc:
+        arrs = self._nodeArrays()
+        inds = arrs['index']
+        # set the coupling conductances
+        s_mat = np.empty((len(freqs), len(inds), len(inds)), dtype=freqs.dtype)
+        s_mat[:] = self._calcCouplingMatrix(arrs=arrs)[None,:,:]
+        # set the ion channel contributions, evaluated at all nodes at once,
+        # the membrane contributions to the diagonal are accumulated first
+        # and added to the matrix at once
+        names, g_terms = self._calcMembraneConductanceTerms(freqs,
+                                            channel_names, arrs=arrs)
+        g_chan = np.array([arrs['currents'][channel_name][0] \
+                           for channel_name in names]).reshape(-1, len(inds))
+        s_diag = np.einsum('cn,cfn->fn', g_chan, g_terms)
+        # set the capacitance contribution
+        if with_ca:
+            s_diag += freqs[:,None] * arrs['ca'][None,:]
+        s_mat[:,inds,inds] += s_diag
+        if use_conc:
+            for node in arrs['nodes']:
+                ii = node.index
                 for ion, concmech in node.concmechs.items():
                     c_term = node.calcMembraneConcentrationTerms(
-                                        ion, self.channel_storage,
-                                        freqs=freqs, channel_names=channel_names)
+                                    ion, self.channel_storage,
+                                    freqs=freqs, channel_names=channel_names)
                     s_mat[:,ii,ii] += concmech.gamma * c_term
 
         if indexing == 'locs':
-            s_mat = self._permuteToLocs(s_mat)
+            s_mat = self._permuteToLocs(s_mat, arrs=arrs)
         elif not indexing == 'tree':
             raise ValueError('invalid argument for `indexing`, ' + \
                              'has to be \'tree\' or \'locs\'')
 
         return s_mat[0,:,:] if no_freq_dim else s_mat
 
-    def calcEigenvalues(self, indexing='tree'):
+    def calcEigenvalues(self, indexing='tree', dtype=np.float64):
         """
         Calculates the eigenvalues and eigenvectors of the passive system
 
-        Returns
-        -------
-        np.ndarray (ndim = 1, dtype = complex)
-            the eigenvalues
-        np.ndarray (ndim = 2, dtype = complex)
-            the right eigenvector matrix
+        Parameters
+        ----------
         indexing: 'tree' or 'locs'
             Whether the indexing order of the matrix corresponds to the tree
             nodes (order in which they occur in the iteration) or to the
             locations on which the reduced model is based
+        dtype: `np.float64` or `np.float32`
+            The precision of the eigendecomposition. In single precision,
+            the relative error on the eigenvalues is of the order of 1e-7
+            times the ratio of the largest to the smallest eigenvalue.
+
+        Returns
+        -------
+        np.ndarray (ndim = 1, dtype = `dtype`)
+            the eigenvalues
+        np.ndarray (ndim = 2, dtype = `dtype`)
+            the right eigenvector matrix
+        np.ndarray (ndim = 2, dtype = `dtype`)
+            the inverse of the right eigenvector matrix, scaled with the
+            inverse capacitance
         """
         # get the system matrix
         mat = self.calcSystemMatrix(freqs=0., channel_names=['L'],
@@ -739,19 +1137,23 @@ class CompartmentTree(STree):
         ca_vec = np.array([node.ca for node in self])
         if indexing == 'locs':
             ca_vec = self._permuteToLocs(ca_vec)
-        mat /= ca_vec[:,None]
+        # the system matrix is symmetric, so that the similarity transform
+        # with diag(sqrt(ca)) yields a symmetric operator with real spectrum
+        # and orthogonal eigenvectors
+        sqrt_ca = np.sqrt(ca_vec)
+        mat /= sqrt_ca[:,None] * sqrt_ca[None,:]
+        mat = mat.astype(dtype, copy=False)
+        sqrt_ca = sqrt_ca.astype(dtype)
         # compute the eigenvalues
-        alphas, phimat = la.eig(mat)
-        if max(np.max(np.abs(alphas.imag)), np.max(np.abs(phimat.imag))) < 1e-5:
-            alphas = alphas.real
-            phimat = phimat.real
-        phimat_inv = la.inv(phimat)
+        alphas, qmat = la.eigh(mat, overwrite_a=True, check_finite=False)
+        phimat = qmat / sqrt_ca[:,None]
+        phimat_inv = qmat.T * sqrt_ca[None,:]
 
         alphas /= -1e3
         phimat_inv /= ca_vec[None,:] * 1e3
         return alphas, phimat, phimat_inv
 
-    def _calcConvolution(self, dt, inputs):
+    def _calcConvolution(self, dt, inputs, dtype=np.float64):
         """
         Compute the convolution of the `inputs` with the impedance matrix of the
         passive system
@@ -762,6 +1164,9 @@ class CompartmentTree(STree):
             The inputs. First dimension is the input site (tree indices) and
             last dimension is time. Middle dimension can be arbitrary. Convolution
             is computed for all elements on the first 2 axes
+        dtype: `np.float64` or `np.float32`
+            The precision in which the eigendecomposition and the convolution
+            are computed, the result is returned in double precision
 
         Return
         ------
@@ -769,31 +1174,57 @@ class CompartmentTree(STree):
             The convolutions
         """
         # compute the system eigenvalues for convolution
-        alphas, phimat, phimat_inv = self.calcEigenvalues()
-        # propagator s to compute convolution
+        alphas, phimat, phimat_inv = self.calcEigenvalues(dtype=dtype)
+        # propagator s to compute convolution, in double precision as `p1`
+        # and `p2` are differences of nearly equal terms for slow modes
+        alphas = alphas.astype(np.float64)
         p0 = np.exp(alphas*dt)
         p1 = - 1. / alphas + (p0 - 1.) / (alphas**2 * dt)
         p2 =   p0 / alphas - (p0 - 1.) / (alphas**2 * dt)
         p_ = - 1. / alphas
-        # multiply input matrix with phimat (original indices kct)
-        inputs = np.einsum('nk,kct->nkct', phimat_inv, inputs)
-        inputs = np.einsum('ln,nkct->lnkct', phimat, inputs)
-        inputs = np.moveaxis(inputs, -1, 0) #tlnkc
+        p0, p1, p2, p_ = [p.astype(dtype) for p in (p0, p1, p2, p_)]
+        if not np.iscomplexobj(inputs):
+            inputs = np.asarray(inputs, dtype=dtype)
+        # the convolution is linear and acts on each mode separately, so that
+        # the output sites only enter in the final contraction
+        if numba is not None:
+            inputs = np.ascontiguousarray(inputs)
+            convres = np.empty((len(alphas),) + inputs.shape,
+                               dtype=np.result_type(phimat_inv, inputs))
+            _modeConvolution(p0, p1, p2, p_, phimat_inv, inputs, convres)
+            # back to the output sites and sum over modes, as a single matrix
+            # product
+            convres = np.tensordot(phimat, convres, axes=(1,0)) # lkct
+
+            return convres.real.astype(np.float64, copy=False)
+
+        # the inputs (original indices kct) are projected on the eigenmodes
+        # one time step at a time
+        p0, p1, p2, p_ = [p[:,None,None] for p in (p0, p1, p2, p_)]
+        phimat_inv = phimat_inv[:,:,None]
+        inputs = np.moveaxis(inputs, -1, 0) # tkc
+        n_t = inputs.shape[0]
+        dtype = np.result_type(phimat_inv, inputs)
+        convres = np.empty((n_t, len(alphas)) + inputs.shape[1:], dtype=dtype)
+        inp, inp_prev, aux = [np.empty(convres.shape[1:], dtype=dtype) \
+                              for _ in range(3)]
         # do the convolution
-        convres = np.zeros_like(inputs)
-        convvar = np.einsum('n,lnkc->lnkc', p_, inputs[0])
-        convres[0] = convvar
-        for kk, inp in enumerate(inputs[1:]):
-            inp_prev = inputs[kk]
-            convvar = np.einsum('n,lnkc->lnkc', p0, convvar) + \
-                      np.einsum('n,lnkc->lnkc', p1, inp) + \
-                      np.einsum('n,lnkc->lnkc', p2, inp_prev)
-            convres[kk+1] = convvar
-        # recast result
-        convres = np.einsum('tlnkc->tlkc', convres)
-        convres = np.moveaxis(convres, 0, -1) # lkct
-
-        return convres.real
+        np.multiply(phimat_inv, inputs[0][None,:,:], out=inp_prev)
+        np.multiply(p_, inp_prev, out=convres[0])
+        for tt in range(1, n_t):
+            np.multiply(phimat_inv, inputs[tt][None,:,:], out=inp)
+            np.multiply(p0, convres[tt-1], out=convres[tt])
+            np.multiply(p1, inp, out=aux)
+            convres[tt] += aux
+            np.multiply(p2, inp_prev, out=aux)
+            convres[tt] += aux
+            inp, inp_prev = inp_prev, inp
+        # back to the output sites and sum over modes, as a single matrix
+        # product
+        convres = np.tensordot(phimat, convres, axes=(1,1)) # ltkc
+        convres = np.ascontiguousarray(np.moveaxis(convres, 1, -1)) # lkct
+
+        return convres.real.astype(np.float64, copy=False)
 
     def _preprocessZMatArg(self, z_mat_arg):
         if isinstance(z_mat_arg, np.ndarray):
@@ -848,32 +1279,49 @@ class CompartmentTree(STree):
         return freqs, w_freqs, z_mat_arg
 
     def _toStructureTensorGMC(self, channel_names):
-        g_vec = self._toVecGMC(channel_names)
-        g_struct = np.zeros((len(self), len(self), len(g_vec)))
-        kk = 0 # counter
-        for node in self:
-            ii = node.index
-            g_terms = node.calcMembraneConductanceTerms(self.channel_storage,
-                                freqs=0., channel_names=['L']+channel_names)
-            if node.parent_node == None:
-                # membrance conductance elements
-                for channel_name in channel_names:
-                    g_struct[0, 0, kk] += g_terms[channel_name]
-                    kk += 1
-            else:
-                jj = node.parent_node.index
-                # coupling conductance element
-                g_struct[ii, jj, kk] -= 1.
-                g_struct[jj, ii, kk] -= 1.
-                g_struct[jj, jj, kk] += 1.
-                g_struct[ii, ii, kk] += 1.
-                kk += 1
-                # membrance conductance elements
-                for channel_name in channel_names:
-                    g_struct[ii, ii, kk] += g_terms[channel_name]
-                    kk += 1
+        rows, cols, kks, vals, shape = self._toStructureCooGMC(channel_names)
+        g_struct = np.zeros(shape)
+        np.add.at(g_struct, (rows, cols, kks), vals)
         return g_struct
 
+    def _toStructureCooGMC(self, channel_names):
+        """
+        The structure tensor of the coupling and membrane conductances has at
+        most four non-zero elements for each conductance. Returns these
+        elements in coordinate format, i.e. the index arrays `rows`, `cols`
+        and `kks` and the values `vals`, with
+        `g_struct[rows[n], cols[n], kks[n]] += vals[n]`, and the shape of the
+        structure tensor.
+        """
+        arrs = self._nodeArrays()
+        shape = (len(arrs['nodes']), len(arrs['nodes']),
+                 self._countGVecGMC(channel_names))
+        # conductance terms of all nodes, evaluated at zero frequency
+        names, g_terms = self._calcMembraneConductanceTerms(np.zeros(1),
+                        ['L']+channel_names, arrs=arrs)
+        # position of the first element of each node in `g_vec`, the
+        # root has no coupling conductance
+        has_parent = arrs['parent'] >= 0
+        n_elem = len(channel_names) + has_parent
+        kk0 = np.cumsum(n_elem) - n_elem
+        # coupling conductance elements
+        ii = arrs['index'][has_parent]
+        jj = arrs['index'][arrs['parent'][has_parent]]
+        kk = kk0[has_parent]
+        rows, cols, kks, vals = [np.concatenate([ii, jj, jj, ii])], \
+                                [np.concatenate([jj, ii, jj, ii])], \
+                                [np.tile(kk, 4)], \
+                                [np.repeat([-1., -1., 1., 1.], len(kk))]
+        # membrance conductance elements
+        ii = np.where(has_parent, arrs['index'], 0)
+        for ic, channel_name in enumerate(channel_names):
+            rows.append(ii)
+            cols.append(ii)
+            kks.append(kk0 + has_parent + ic)
+            vals.append(g_terms[names.index(channel_name),0])
+        rows, cols, kks, vals = [np.concatenate(x) for x in (rows, cols, kks, vals)]
+        return rows, cols, kks, vals, shape
+
     def _toVecGMC(self, channel_names):
         """
         Place all conductances to be fitted in a single vector
@@ -887,6 +1335,13 @@ class CompartmentTree(STree):
                               [node.currents[c_name][0] for c_name in channel_names])
         return np.array(g_list)
 
+    def _countGVecGMC(self, channel_names):
+        """
+        Length of the vector returned by `_toVecGMC`
+        """
+        n_node = len(self)
+        return n_node * len(channel_names) + max(n_node - 1, 0)
+
     def _toTreeGMC(self, g_vec, channel_names):
         kk = 0 # counter
         for ii, node in enumerate(self):
@@ -902,25 +1357,43 @@ class CompartmentTree(STree):
                     kk += 1
 
     def _toStructureTensorGM(self, freqs, channel_names, all_channel_names=None):
+        g_diag = self._toStructureDiagGM(freqs, channel_names,
+                                         all_channel_names=all_channel_names)
+        n_node = g_diag.shape[1]
+        g_struct = np.zeros((len(freqs), n_node, n_node, g_diag.shape[2]),
+                            dtype=g_diag.dtype)
+        inds = np.arange(n_node)
+        g_struct[:,inds,inds,:] = g_diag
+        return g_struct
+
+    def _toStructureDiagGM(self, freqs, channel_names, all_channel_names=None):
+        """
+        The structure tensor of the membrane conductances is only non-zero on
+        the diagonal of its two middle axes. Returns that diagonal, i.e.
+        `g_struct[:,ii,ii,:]` for all tree indices `ii`, as an array of shape
+        ``(F, N, K)``.
+        """
         # to construct appropriate channel vector
         if all_channel_names is None:
             all_channel_names = channel_names
         else:
             assert set(channel_names).issubset(all_channel_names)
-        g_vec = self._toVecGM(all_channel_names)
-        g_struct = np.zeros((len(freqs), len(self), len(self), len(g_vec)), dtype=freqs.dtype)
-        # fill the fit structure
-        kk = 0 # counter
-        for node in self:
-            ii = node.index
-            g_terms = node.calcMembraneConductanceTerms(self.channel_storage,
-                                    freqs=freqs, channel_names=channel_names)
-            # membrance conductance elements
-            for channel_name in all_channel_names:
-                if channel_name in channel_names:
-                    g_struct[:,ii,ii,kk] += g_terms[channel_name]
-                kk += 1
-        return g_struct
+        arrs = self._nodeArrays()
+        inds = arrs['index']
+        g_diag = np.zeros((len(freqs), len(inds),
+                           self._countGVecGM(all_channel_names)),
+                          dtype=freqs.dtype)
+        # conductance terms of all nodes
+        names, g_terms = self._calcMembraneConductanceTerms(freqs,
+                                            channel_names, arrs=arrs)
+        # membrance conductance elements, `g_vec` holds the conductances of
+        # all channels node by node
+        n_chan = len(all_channel_names)
+        for ic, channel_name in enumerate(all_channel_names):
+            if channel_name in channel_names:
+                kk = np.arange(len(inds)) * n_chan + ic
+                g_diag[:,inds,kk] += g_terms[names.index(channel_name)]
+        return g_diag
 
     def _toVecGM(self, channel_names):
         """
@@ -931,6 +1404,12 @@ class CompartmentTree(STree):
             g_list.extend([node.currents[c_name][0] for c_name in channel_names])
         return np.array(g_list)
 
+    def _countGVecGM(self, channel_names):
+        """
+        Length of the vector returned by `_toVecGM`
+        """
+        return len(self) * len(channel_names)
+
     def _toTreeGM(self, g_vec, channel_names):
         kk = 0 # counter
         for ii, node in enumerate(self):
@@ -939,16 +1418,28 @@ class CompartmentTree(STree):
                 kk += 1
 
     def _toStructureTensorConc(self, ion, freqs, channel_names):
-        # to construct appropriate channel vector
-        c_struct = np.zeros((len(freqs), len(self), len(self), len(self)), dtype=freqs.dtype)
-        # fill the fit structure
-        for node in self:
-            ii = node.index
-            c_term = node.calcMembraneConcentrationTerms(ion, self.channel_storage,
-                                    freqs=freqs, channel_names=channel_names)
-            c_struct[:,ii,ii,ii] += c_term
+        c_diag = self._toStructureDiagConc(ion, freqs, channel_names)
+        n_node = c_diag.shape[1]
+        c_struct = np.zeros((len(freqs), n_node, n_node, n_node),
+                            dtype=c_diag.dtype)
+        inds = np.arange(n_node)
+        c_struct[:,inds,inds,:] = c_diag
         return c_struct
 
+    def _toStructureDiagConc(self, ion, freqs, channel_names):
+        """
+        Diagonal of the two middle axes of the structure tensor of the
+        concentration mechanisms (see `_toStructureDiagGM`), of shape
+        ``(F, N, N)``
+        """
+        arrs = self._nodeArrays()
+        inds = arrs['index']
+        c_diag = np.zeros((len(freqs), len(inds), len(inds)), dtype=freqs.dtype)
+        # fill the fit structure
+        c_diag[:,inds,inds] += self._calcMembraneConcentrationTerms(ion, freqs,
+                                            channel_names, arrs=arrs)
+        return c_diag
+
     def _toVecConc(self, ion):
         """
         Place concentration mechanisms to be fitted in a single vector
@@ -960,12 +1451,10 @@ class CompartmentTree(STree):
             node.concmechs[ion].gamma = c_vec[ii]
 
     def _toStructureTensorC(self, freqs):
-        c_vec = self._toVecC()
-        c_struct = np.zeros((len(freqs), len(self), len(self), len(c_vec)), dtype=complex)
-        for node in self:
-            ii = node.index
-            # capacitance elements
-            c_struct[:, ii, ii, ii] += freqs
+        inds = np.array([node.index for node in self], dtype=int)
+        c_struct = np.zeros((len(freqs), len(inds), len(inds), len(inds)), dtype=complex)
+        # capacitance elements
+        c_struct[:, inds, inds, inds] += freqs[:,None]
         return c_struct
 
     def _toVecC(self):
@@ -998,26 +1487,28 @@ class CompartmentTree(STree):
         z_mat_arg = self._preprocessZMatArg(z_mat_arg)
         e_eqs, _ = self._preprocessEEqs(e_eqs)
         assert len(z_mat_arg) == len(e_eqs)
+        # the feature matrix and target vector, each equilibrium potential
+        # contributes a block of N*N rows
+        n_row = len(self)**2
+        mat_feature = np.empty((len(z_mat_arg) * n_row,
+                                self._countGVecGMC(channel_names)),
+                               dtype=np.result_type(float, *z_mat_arg))
+        vec_target = np.tile(np.eye(len(self)).ravel(), len(z_mat_arg))
         # do the fit
-        mats_feature = []
-        vecs_target = []
-        for z_mat, e_eq in zip(z_mat_arg, e_eqs):
+        for ii, (z_mat, e_eq) in enumerate(zip(z_mat_arg, e_eqs)):
             # set equilibrium conductances
             self.setEEq(e_eq)
             # create the matrices for linear fit
-            g_struct = self._toStructureTensorGMC(channel_names)
-            tensor_feature = np.einsum('ij,jkl->ikl', z_mat, g_struct)
-            tshape = tensor_feature.shape
-            mat_feature_aux = np.reshape(tensor_feature,
-                                         (tshape[0]*tshape[1], tshape[2]))
-            vec_target_aux = np.reshape(np.eye(len(self)), (len(self)*len(self),))
-            mats_feature.append(mat_feature_aux)
-            vecs_target.append(vec_target_aux)
-        mat_feature = np.concatenate(mats_feature, 0)
-        vec_target = np.concatenate(vecs_target)
+            rows, cols, kks, vals, shape = self._toStructureCooGMC(channel_names)
+            # contract with the sparse structure tensor, flattened to a
+            # matrix of shape (N, N*K)
+            g_sparse = sparse.csr_matrix((vals, (rows, cols*shape[2] + kks)),
+                                         shape=(shape[0], shape[1]*shape[2]))
+            mat_feature[ii*n_row:(ii+1)*n_row] = np.reshape(
+                (g_sparse.T @ z_mat.T).T, (n_row, shape[2]))
         # linear regression fit
         # res = la.lstsq(mat_feature, vec_target)
-        res = so.nnls(mat_feature, vec_target)
+        res = _nnls(mat_feature, vec_target)
         g_vec = res[0].real
         # set the conductances
         self._toTreeGMC(g_vec, channel_names)
@@ -1025,7 +1516,7 @@ class CompartmentTree(STree):
     def computeGChanFromImpedance(self, channel_names, z_mat, e_eq, freqs,
                                 sv={}, weight=1.,
                                 all_channel_names=None, other_channel_names=None,
-                                action='store'):
+                                action='store', dtype=np.float64):
         """
         Fit the conductances of multiple channels from the given impedance
         matrices, or store the feature matrix and target vector for later use
@@ -1064,6 +1555,10 @@ class CompartmentTree(STree):
             on. Relative weight in fit will be determined by `weight`.
             If 'return', returns the feature matrix and target vector. Nothing
             is stored
+        dtype: np.float64 (default) or np.float32
+            The precision of the feature matrix and target vector. Single
+            precision halves their memory footprint and the cost of the fit,
+            the fitted conductances are accurate to about six digits
         """
         # to construct appropriate channel vector
         if all_channel_names is None:
@@ -1081,18 +1576,22 @@ class CompartmentTree(STree):
         # set channel expansion point
         self.setExpansionPoints(sv)
         # feature matrix
-        g_struct = self._toStructureTensorGM(freqs=freqs, channel_names=channel_names,
-                                             all_channel_names=all_channel_names)
-        tensor_feature = np.einsum('oij,ojkl->oikl', z_mat, g_struct)
+        g_diag = self._toStructureDiagGM(freqs=freqs, channel_names=channel_names,
+                                         all_channel_names=all_channel_names)
+        z_mat, g_diag = _asPrecision(z_mat, dtype), _asPrecision(g_diag, dtype)
+        # the structure tensor is diagonal in the contracted index
+        tensor_feature = z_mat[:,:,:,None] * g_diag[:,None,:,:]
         tshape = tensor_feature.shape
         mat_feature = np.reshape(tensor_feature,
                                      (tshape[0]*tshape[1]*tshape[2], tshape[3]))
         # target vector
         g_mat = self.calcSystemMatrix(freqs,
                             channel_names=other_channel_names, indexing='tree')
-        zg_prod = np.einsum('oij,ojk->oik', z_mat, g_mat)
+        zg_prod = np.matmul(z_mat, g_mat)
         mat_target = np.eye(len(self))[np.newaxis,:,:] - zg_prod
-        vec_target = np.reshape(mat_target, (tshape[0]*tshape[1]*tshape[2],))
+        vec_target = _asPrecision(
+            np.reshape(mat_target, (tshape[0]*tshape[1]*tshape[2],)), dtype
+        )
 
         return self._fitResAction(action, mat_feature, vec_target, weight,
                                   channel_names=all_channel_names)
@@ -1100,7 +1599,7 @@ class CompartmentTree(STree):
     def computeGSingleChanFromImpedance(self, channel_name, z_mat, e_eq, freqs,
                                 sv=None, weight=1.,
                                 all_channel_names=None, other_channel_names=None,
-                                action='store'):
+                                action='store', dtype=np.float64):
         """
         Fit the conductances of a single channel from the given impedance
         matrices, or store the feature matrix and target vector for later use
@@ -1139,6 +1638,10 @@ class CompartmentTree(STree):
             on. Relative weight in fit will be determined by `weight`.
             If 'return', returns the feature matrix and target vector. Nothing
             is stored
+        dtype: np.float64 (default) or np.float32
+            The precision of the feature matrix and target vector. Single
+            precision halves their memory footprint and the cost of the fit,
+            the fitted conductances are accurate to about six digits
         """
         # to construct appropriate channel vector
         if all_channel_names is None:
@@ -1158,18 +1661,22 @@ class CompartmentTree(STree):
         # set channel expansion point
         self.setExpansionPoints(sv)
         # feature matrix
-        g_struct = self._toStructureTensorGM(freqs=freqs, channel_names=[channel_name],
-                                             all_channel_names=all_channel_names)
-        tensor_feature = np.einsum('oij,ojkl->oikl', z_mat, g_struct)
+        g_diag = self._toStructureDiagGM(freqs=freqs, channel_names=[channel_name],
+                                         all_channel_names=all_channel_names)
+        z_mat, g_diag = _asPrecision(z_mat, dtype), _asPrecision(g_diag, dtype)
+        # the structure tensor is diagonal in the contracted index
+        tensor_feature = z_mat[:,:,:,None] * g_diag[:,None,:,:]
         tshape = tensor_feature.shape
         mat_feature = np.reshape(tensor_feature,
                                      (tshape[0]*tshape[1]*tshape[2], tshape[3]))
         # target vector
         g_mat = self.calcSystemMatrix(freqs,
                             channel_names=other_channel_names, indexing='tree')
-        zg_prod = np.einsum('oij,ojk->oik', z_mat, g_mat)
+        zg_prod = np.matmul(z_mat, g_mat)
         mat_target = np.eye(len(self))[np.newaxis,:,:] - zg_prod
-        vec_target = np.reshape(mat_target, (tshape[0]*tshape[1]*tshape[2],))
+        vec_target = _asPrecision(
+            np.reshape(mat_target, (tshape[0]*tshape[1]*tshape[2],)), dtype
+        )
 
         self.removeExpansionPoints()
 
@@ -1181,7 +1688,6 @@ class CompartmentTree(STree):
         """
         Experimental function to fit the parameters of concentration mechanisms
         """
-        np.set_printoptions(precision=5, linewidth=200)
         if sv_s is None:
             sv_s = [None for _ in channel_names]
         exp_points = {c_name: sv for c_name, sv in zip(channel_names, sv_s)}
@@ -1192,10 +1698,15 @@ class CompartmentTree(STree):
             freqs = np.array([freqs])
         # set equilibrium conductances
         self.setEEq(e_eq)
-        # feature matrix
-        g_struct = self._toStructureTensorConc(ion, freqs, channel_names)
-
-        tensor_feature = np.einsum('oij,ojkl->oikl', z_mat, g_struct)
+        # feature matrix, the diagonal of the structure tensor is itself
+        # diagonal, so that each row has a single non-zero element
+        c_terms = np.diagonal(
+            self._toStructureDiagConc(ion, freqs, channel_names), axis1=1, axis2=2
+        )
+        inds = np.arange(len(self))
+        tensor_feature = np.zeros(z_mat.shape + (len(inds),),
+                                  dtype=np.result_type(z_mat, c_terms))
+        tensor_feature[:,:,inds,inds] = z_mat * c_terms[:,None,:]
         tshape = tensor_feature.shape
         mat_feature = np.reshape(tensor_feature,
                                      (tshape[0]*tshape[1]*tshape[2], tshape[3]))
@@ -1203,15 +1714,10 @@ class CompartmentTree(STree):
         g_mat = self.calcSystemMatrix(freqs, channel_names=channel_names+['L'],
                                              indexing='tree')
 
-        zg_prod = np.einsum('oij,ojk->oik', z_mat, g_mat)
+        zg_prod = np.matmul(z_mat, g_mat)
         mat_target = np.eye(len(self))[np.newaxis,:,:] - zg_prod
         vec_target = np.reshape(mat_target, (tshape[0]*tshape[1]*tshape[2],))
 
-        # print(np.set_printoptions(precision=2))
-        # print('z_mat fitted   =\n', self.calcImpedanceMatrix(use_conc=True, freqs=freqs, channel_names=channel_names)[0].real)
-        # print('z_mat standard =\n', self.calcImpedanceMatrix(use_conc=True, freqs=freqs, channel_names=channel_names)[0].real)
-        # print('z_mat no conc  =\n', self.calcImpedanceMatrix(use_conc=False, freqs=freqs, channel_names=channel_names)[0].real)
-
         self.removeExpansionPoints()
 
         return self._fitResAction(action, mat_feature, vec_target, weight, ion=ion)
@@ -1252,7 +1758,7 @@ class CompartmentTree(STree):
             vec_target[ii*n_a:(ii+1)*n_a] = np.reshape(np.dot(phimat, g_mat[ii:ii+1,:].T) - gamma_mat[:,ii:ii+1], n_a) * weights
 
         # least squares fit
-        res = so.nnls(mat_feature, vec_target)[0]
+        res = _nnls(mat_feature, vec_target)[0]
         c_vec = res + c_lim
         self._toTreeC(c_vec)
 
@@ -1386,6 +1892,7 @@ class CompartmentTree(STree):
         """
 
 
+        ensureAgg()
         import matplotlib.pyplot as pl
         # check size
         assert v_mat.shape == i_mat.shape
@@ -1453,7 +1960,7 @@ class CompartmentTree(STree):
         mat_feature = v_d
         vec_target = v_fit
 
-        g_vec = so.nnls(mat_feature, vec_target)[0]
+        g_vec = _nnls(mat_feature, vec_target)[0]
         print('g single fit =', g_vec)
 
         n_panel = len(self)+1
@@ -1505,7 +2012,7 @@ class CompartmentTree(STree):
                             ca_lim=[], **kwargs):
         if action == 'fit':
             # linear regression fit
-            res = so.nnls(mat_feature, vec_target)
+            res = _nnls(mat_feature, vec_target)
             vec_res = res[0].real
             # set the conductances
             if 'channel_names' in kwargs:
@@ -1574,14 +2081,22 @@ class CompartmentTree(STree):
         """
         fit_data = self.fit_data
         if len(fit_data['mats_feature']) > 0:
-            # apply the weights
+            # create the fit matrices, the weighted blocks are written
+            # directly in the preallocated output
+            n_row = sum(len(v_t) for v_t in fit_data['vecs_target'])
+            mat_feature = np.empty(
+                (n_row, fit_data['mats_feature'][0].shape[1]),
+                dtype=np.result_type(*fit_data['mats_feature'])
+            )
+            vec_target = np.empty(n_row,
+                dtype=np.result_type(*fit_data['vecs_target'])
+            )
+            ii = 0
             for (m_f, v_t, w_f) in zip(fit_data['mats_feature'], fit_data['vecs_target'], fit_data['weights_fit']):
                 nn = len(v_t)
-                m_f *= w_f / nn
-                v_t *= w_f / nn
-            # create the fit matrices
-            mat_feature = np.concatenate(fit_data['mats_feature'])
-            vec_target = np.concatenate(fit_data['vecs_target'])
+                np.multiply(m_f, w_f / nn, out=mat_feature[ii:ii+nn])
+                np.multiply(v_t, w_f / nn, out=vec_target[ii:ii+nn])
+                ii += nn
             # do the fit
             if len(fit_data['channel_names']) > 0:
                 self._fitResAction('fit', mat_feature, vec_target, 1.,
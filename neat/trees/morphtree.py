@@ -10,6 +10,8 @@ Authors: B. Torben-Nielsen (legacy code) and W. Wybo
 
 import numpy as np
 
+from .._mpl import ensureAgg
+ensureAgg()
 import matplotlib.patheffects as patheffects
 import matplotlib.patches as patches
 import matplotlib.cm as cm
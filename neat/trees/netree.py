@@ -10,6 +10,9 @@ Author: W. Wybo
 
 
 import numpy as np
+
+from .._mpl import ensureAgg
+ensureAgg()
 import matplotlib.pyplot as pl
 
 from .stree import STree, SNode
@@ -11,7 +11,7 @@ from setuptools.extension import Extension
 from setuptools.command.develop import develop
 from setuptools.command.install import install
 
-import os, subprocess, shutil, sys
+import os, subprocess, shutil, sys, compileall
 
 import numpy
 
@@ -45,6 +45,7 @@ class PostInstallCommand(install):
         install.run(self)
         # execute post installation commands
         compile_default_ion_channels()
+        compile_bytecode(os.path.join(self.install_lib, 'neat'))
 
 
 def write_ionchannel_header_and_cpp_file():
@@ -90,11 +91,48 @@ def compile_default_ion_channels():
     os.chdir(cwd)
 
 
+def compile_bytecode(pkg_dir):
+    """
+    Writes the bytecode of the installed package for all optimization levels,
+    so that the first `import neat` does not need to compile the sources.
+    """
+    for optimize in (0, 1, 2):
+        compileall.compile_dir(pkg_dir, optimize=optimize, workers=0, quiet=1)
+
+
 def read_requirements():
     with open('./requirements.txt') as fp:
         requirements = fp.read()
     return requirements
 
+def netsim_compile_args():
+    """
+    Compiler and linker flags for the netsim extension. The generated ion
+    channel code does not rely on `errno` or floating point traps. Only the
+    module init function is exported, so that calls between the simulator
+    and the channels are not routed through the PLT. `-fopenmp-simd` enables
+    the `omp simd` loops of the batched channel kernels, without linking
+    the OpenMP runtime.
+
+    `NEAT_NATIVE=1` optimizes for the build machine (the extension then
+    does not run on older CPUs) and `NEAT_FAST_MATH=1` allows the compiler
+    to reorder floating point operations, which changes results at the
+    rounding level.
+    """
+    compile_args = ["-w", "-O3", "-std=gnu++11", "-funroll-loops",
+                    "-fno-math-errno", "-fno-trapping-math",
+                    "-fvisibility=hidden", "-fopenmp-simd"]
+    link_args = []
+    if os.environ.get('NEAT_NATIVE') == '1':
+        compile_args += ["-march=native", "-flto"]
+        link_args += ["-flto"]
+    if os.environ.get('NEAT_FAST_MATH') == '1':
+        compile_args += ["-ffast-math"]
+
+    return compile_args, link_args
+
+
+compile_args, link_args = netsim_compile_args()
 ext = Extension("netsim",
                 ["neat/tools/simtools/net/netsim.pyx",
                  "neat/tools/simtools/net/NETC.cc",
@@ -102,7 +140,8 @@ ext = Extension("netsim",
                  "neat/tools/simtools/net/Ionchannels.cc",
                  "neat/tools/simtools/net/Tools.cc"],
                 language="c++",
-                extra_compile_args=["-w", "-O3", "-std=gnu++11"],
+                extra_compile_args=compile_args,
+                extra_link_args=link_args,
                 include_dirs=[numpy.get_include()])
 
 
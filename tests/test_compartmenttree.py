@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.optimize as so
 import matplotlib.pyplot as pl
 
 import pytest
@@ -289,6 +290,12 @@ class TestCompartmentTree():
         assert np.allclose(np.dot(phimat, phimat_inv), np.diag(ca_vec))
         assert np.allclose(np.array([n.ca / n.currents['L'][0] for n in self.ctree]),
                            np.ones(len(self.ctree)) * np.max(1e-3/np.abs(alphas)))
+        # single precision eigendecomposition
+        alphas_, phimat_, phimat_inv_ = self.ctree.calcEigenvalues(dtype=np.float32)
+        assert alphas_.dtype == np.float32
+        assert np.allclose(alphas_, alphas, rtol=1e-4, atol=0.)
+        assert np.allclose(np.dot(phimat_, phimat_inv_), np.diag(ca_vec),
+                           rtol=0., atol=1e-4*np.max(ca_vec))
 
     def loadBall(self):
         self.greens_tree = GreensTree(file_n='test_morphologies/ball.swc')
@@ -386,6 +393,7 @@ class TestCompartmentTree():
         ctree2 = copy.deepcopy(ctree)
         ctree3 = copy.deepcopy(ctree)
         ctree4 = copy.deepcopy(ctree)
+        ctree5 = copy.deepcopy(ctree)
 
         # fit paradigm 1 --> separate impedance matrices and separate fits
         # potassium channel fit
@@ -413,6 +421,12 @@ class TestCompartmentTree():
             ctree3.computeGChanFromImpedance(['Kv3_1', 'Na_Ta'], z_mat_comb, e_eq, self.freqs)
         ctree3.runFit()
 
+        # fit paradigm 3 in single precision
+        for z_mat_comb, e_eq in zip(z_mats_comb, e_eqs):
+            ctree5.computeGChanFromImpedance(['Kv3_1', 'Na_Ta'], z_mat_comb, e_eq, self.freqs,
+                                             dtype=np.float32)
+        ctree5.runFit()
+
         # fit paradigm 4 --> fit incrementally
         for z_mat_na, e_eq, sv in zip(z_mats_na, e_eqs_, svs):
             ctree4.computeGSingleChanFromImpedance('Na_Ta', z_mat_na, e_eq, self.freqs, sv=sv)
@@ -436,6 +450,8 @@ class TestCompartmentTree():
         assert np.allclose(conds, cconds2)
         assert np.allclose(conds, cconds3)
         assert np.allclose(conds, cconds4)
+        cconds5 = np.array([ctree5[0].currents[key][0] for key in keys])
+        assert np.allclose(cconds3, cconds5, rtol=1e-4, atol=0.)
 
         # rename for further testing
         ctree = ctree1
@@ -516,6 +532,84 @@ class TestCompartmentTree():
         assert np.abs(ctree[0].currents['L'][1] - self.greens_tree[1].currents['L'][1]) < 1e-10
 
 
+def test_nnls():
+    from neat.trees.compartmenttree import _nnls
+    rng = np.random.RandomState(37)
+
+    # tall systems with full rank, where the solution is unique
+    for n_row, n_col in [(50, 5), (200, 20), (21, 20)]:
+        mat = rng.randn(n_row, n_col)
+        # negative components of the target make constraints active
+        x_target = rng.randn(n_col)
+        vec = np.dot(mat, x_target) + 0.1 * rng.randn(n_row)
+        x, r_norm = _nnls(mat, vec)
+        x_, r_norm_ = so.nnls(mat, vec)
+        assert np.all(x >= 0.)
+        assert np.any(x == 0.)
+        assert np.allclose(x, x_, atol=1e-10)
+        assert np.allclose(r_norm, r_norm_)
+        assert np.allclose(r_norm, np.linalg.norm(np.dot(mat, x) - vec))
+
+    # rank deficient systems, the solution is not unique but the residual is
+    for n_row, n_col, rank in [(60, 10, 6), (30, 8, 1)]:
+        mat = np.dot(rng.randn(n_row, rank), rng.randn(rank, n_col))
+        vec = rng.randn(n_row)
+        x, r_norm = _nnls(mat, vec)
+        x_, r_norm_ = so.nnls(mat, vec)
+        assert np.all(x >= 0.)
+        assert np.allclose(r_norm, r_norm_)
+        assert np.allclose(r_norm, np.linalg.norm(np.dot(mat, x) - vec))
+
+    # wide systems are passed on unchanged
+    mat = rng.randn(5, 10)
+    vec = rng.randn(5)
+    x, r_norm = _nnls(mat, vec)
+    x_, r_norm_ = so.nnls(mat, vec)
+    assert np.array_equal(x, x_) and r_norm == r_norm_
+
+
+def test_heterogeneous_currents():
+    # the root lacks the channel present at its children, the last child
+    # lacks a channel of the root
+    ctree = CompartmentTree(root=CompartmentNode(0, loc_ind=0, e_eq=-70.))
+    ctree.addNodeWithParent(CompartmentNode(1, loc_ind=1, g_c=0.1, e_eq=-60.),
+                            ctree[0])
+    ctree.addNodeWithParent(CompartmentNode(2, loc_ind=2, g_c=0.2, e_eq=-50.),
+                            ctree[0])
+    na_chan = channelcollection.Na_Ta()
+    k_chan = channelcollection.Kv3_1()
+    ctree.channel_storage['Na_Ta'] = na_chan
+    ctree.channel_storage['Kv3_1'] = k_chan
+    for node, g_k in zip([ctree[0], ctree[1]], [0.3, 0.4]):
+        node.currents['Kv3_1'] = [g_k, -85.]
+    for node, g_na in zip([ctree[1], ctree[2]], [1.1, 1.2]):
+        node.currents['Na_Ta'] = [g_na, 50.]
+
+    arrs = ctree._nodeArrays()
+    assert set(arrs['currents']) == {'L', 'Na_Ta', 'Kv3_1'}
+    assert np.allclose(arrs['currents']['Na_Ta'][0], [0., 1.1, 1.2])
+    assert np.allclose(arrs['currents']['Kv3_1'][0], [0.3, 0.4, 0.])
+
+    # channels absent at a node do not contribute there
+    nodes = arrs['nodes']
+    assert np.allclose(ctree._calcGTot(arrs=arrs),
+                       [node.getGTot(ctree.channel_storage) for node in nodes])
+    assert np.allclose(ctree._calcITot(arrs=arrs),
+                       [node.getITot(ctree.channel_storage) for node in nodes])
+    freqs = np.array([0., 10j])
+    s_mat = ctree.calcSystemMatrix(freqs=freqs, indexing='tree')
+    for node in nodes:
+        g_terms = node.calcMembraneConductanceTerms(ctree.channel_storage,
+                                                    freqs=freqs)
+        s_diag = freqs * node.ca + sum(node.currents[channel_name][0] * \
+                                       g_terms[channel_name] \
+                                       for channel_name in node.currents)
+        s_diag += sum(child.g_c for child in node.child_nodes)
+        if node.parent_node is not None:
+            s_diag += node.g_c
+        assert np.allclose(s_mat[:,node.index,node.index], s_diag)
+
+
 class TestCompartmentTreePlotting():
     def _initTree1(self):
         """
@@ -0,0 +1,111 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+import neat
+
+
+def runPython(code, **env):
+    """
+    Run `code` in a fresh interpreter, so that the state of the `neat` package
+    does not depend on earlier imports
+    """
+    env_ = dict(os.environ)
+    env_.pop('NEAT_LAZY', None)
+    env_.pop('NEAT_PREWARM', None)
+    env_.update(env)
+    res = subprocess.run([sys.executable, '-c', code], env=env_,
+                         capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr
+
+    return res.stdout.split()
+
+
+def test_lazy_import():
+    # nothing from the public API is loaded by importing the package
+    out = runPython(
+        "import sys, neat\n"
+        "print(any(n in vars(neat) for n in neat._LAZY))\n"
+        "print(any(m in sys.modules for m, _ in neat._SPEC))\n"
+        "neat.PhysTree\n"
+        "print('PhysTree' in vars(neat), 'NET' in vars(neat))\n"
+    )
+    assert out == ['False', 'False', 'True', 'False']
+
+
+def test_lazy_binding():
+    for name in neat.__all__:
+        obj = getattr(neat, name)
+        # bound in the package namespace after the first access
+        assert vars(neat)[name] is obj
+        if name in neat._LAZY:
+            module = sys.modules[neat._LAZY[name]]
+            assert getattr(module, name) is obj
+        assert name in dir(neat)
+
+    namespace = {}
+    exec('from neat import *', namespace)
+    assert set(neat.__all__) <= set(namespace)
+    assert namespace['IonChannel'] is neat.IonChannel
+
+
+def test_neuron_missing():
+    cls = neat._neuronMissing('NeuronSimTree')
+    assert cls.__name__ == 'NeuronSimTree'
+    with pytest.raises(ImportError,
+            match='NEURON not available, install `neuron` to use `NeuronSimTree`'):
+        cls()
+    func = neat._neuronMissing('createReducedNeuronModel')
+    assert func.__name__ == 'createReducedNeuronModel'
+    with pytest.raises(ImportError, match='`createReducedNeuronModel`'):
+        func(None)
+
+    # simulate an interpreter without NEURON
+    out = runPython(
+        "import sys\n"
+        "sys.modules['neuron'] = None\n"
+        "import neat\n"
+        "print(neat.__NEURON_AVAILABLE__)\n"
+        "try:\n"
+        "    neat.NeuronSimTree()\n"
+        "except ImportError as e:\n"
+        "    print(str(e).replace(' ', '_'))\n"
+        "try:\n"
+        "    neat.enableNeuron()\n"
+        "except ImportError:\n"
+        "    print('raised')\n"
+    )
+    assert out == ['False',
+                   'NEURON_not_available,_install_`neuron`_to_use_`NeuronSimTree`',
+                   'raised']
+
+
+def test_eager_import():
+    out = runPython(
+        "import sys, neat\n"
+        "print(neat._loaded)\n"
+        "print(all(n in vars(neat) for n in neat._LAZY))\n"
+        "print(all(m in sys.modules for m, _ in neat._SPEC\n"
+        "          if m != neat._NEURON_MODULE))\n",
+        NEAT_LAZY='0',
+    )
+    assert out == ['True', 'True', 'True']
+
+
+def test_misspelled_name():
+    with pytest.raises(AttributeError,
+            match="has no attribute 'PhysTre'. Did you mean: 'PhysTree'"):
+        neat.PhysTre
+    with pytest.raises(AttributeError) as excinfo:
+        neat.compartmentTree
+    assert "'CompartmentTree'" in str(excinfo.value)
+    # no suggestions for private or unrelated names
+    with pytest.raises(AttributeError) as excinfo:
+        neat._PhysTree
+    assert 'Did you mean' not in str(excinfo.value)
+    with pytest.raises(AttributeError) as excinfo:
+        neat.xyz
+    assert 'Did you mean' not in str(excinfo.value)
+    assert not hasattr(neat, 'PhysTre')
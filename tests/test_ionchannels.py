@@ -4,8 +4,14 @@ import sympy as sp
 from neat.channels.channelcollection import channelcollection
 from neat import IonChannel
 
+import os
+import sys
 import pytest
 import pickle
+import types
+import subprocess
+
+import neat.channels.ionchannels as ionchannels
 
 
 class TestChannels():
@@ -153,6 +159,253 @@ def test_pickling():
     assert True  # reaching this means we didn't encounter an error
 
 
+class ConcChannel(IonChannel):
+    """
+    Calcium dependent potassium channel, to test the concentration
+    derivatives
+    """
+    def __init__(self):
+        self.ion = 'k'
+        self.concentrations = ['ca']
+        self.sp_v = sp.symbols('v')
+        sp_ca = sp.symbols('ca')
+        self.varnames = np.array([['n', 'z']])
+        self.powers = np.array([[2, 1]])
+        self.factors = np.array([1.])
+        self.varinf = np.array([[1. / (1. + sp.exp(-(self.sp_v + 30.) / 10.)),
+                                 sp_ca / (sp_ca + 2e-4 * sp.exp(-self.sp_v / 40.))]])
+        self.tauinf = np.array([[sp.Float(5.), 1. + 10. * sp_ca]])
+        super(ConcChannel, self).__init__()
+
+
+def test_linear_array_voltages():
+    # array voltages give the response at each voltage, not their sum
+    v_arr = np.array([-75., -60., -50., -30.])
+    freqs = np.array([0., 10j, 100j])
+    for chan in [channelcollection.Na_Ta(), channelcollection.h(), ConcChannel()]:
+        e_rev = 50.
+        lin = chan.computeLinear(v_arr, freqs[:,None])
+        lin_sum = chan.computeLinSum(v_arr, freqs[:,None], e_rev)
+        assert lin.shape == (len(freqs), len(v_arr))
+        assert lin_sum.shape == (len(freqs), len(v_arr))
+        for ii, v in enumerate(v_arr):
+            for kk, f in enumerate(freqs):
+                assert np.allclose(lin[kk,ii], chan.computeLinear(v, f))
+                assert np.allclose(lin_sum[kk,ii], chan.computeLinSum(v, f, e_rev))
+        # a single frequency broadcasts against the voltages
+        assert np.allclose(chan.computeLinSum(v_arr, 10j, e_rev),
+                           [chan.computeLinSum(v, 10j, e_rev) for v in v_arr])
+
+    chan = ConcChannel()
+    lin_c = chan.computeLinearConc(v_arr, freqs[:,None], 'ca')
+    lin_c_ = chan.computeLinConc(v_arr, freqs[:,None], -85., 'ca')
+    assert lin_c.shape == (len(freqs), len(v_arr))
+    assert not np.allclose(lin_c, 0.)
+    for ii, v in enumerate(v_arr):
+        for kk, f in enumerate(freqs):
+            assert np.allclose(lin_c[kk,ii], chan.computeLinearConc(v, f, 'ca'))
+            assert np.allclose(lin_c_[kk,ii], chan.computeLinConc(v, f, -85., 'ca'))
+
+
+def test_statevars_p_open(monkeypatch):
+    calls = []
+    minimize = ionchannels.so.minimize
+    def counting_minimize(*args, **kwargs):
+        calls.append(1)
+        return minimize(*args, **kwargs)
+    monkeypatch.setattr(ionchannels.so, 'minimize', counting_minimize)
+
+    # single product of state variables, solved in closed form
+    chan = channelcollection.Na_Ta()
+    for v, p_open in [(-75., 0.01), (-50., 0.2)]:
+        sv = chan.findStatevarsVPGiven(v, p_open)
+        assert sv.shape == chan.statevars.shape
+        assert np.all(sv >= 0.1) and np.all(sv <= 0.9)
+        assert np.allclose(chan.computePOpen(v, statevars=sv), p_open)
+    assert len(calls) == 0
+    # closed form solution outside of the bounds uses the optimizer
+    sv = chan.findStatevarsVPGiven(-75., 0.9)
+    assert len(calls) == 1
+    assert np.all(sv >= 0.1 - 1e-8) and np.all(sv <= 0.9 + 1e-8)
+
+    # channels with multiple terms use the optimizer
+    chan = channelcollection.h()
+    assert len(chan.factors) > 1
+    sv = chan.findStatevarsVPGiven(-75., 0.3)
+    assert len(calls) == 2
+    assert np.all(sv >= 0.1 - 1e-8) and np.all(sv <= 0.9 + 1e-8)
+    assert np.abs(chan.computePOpen(-75., statevars=sv) - 0.3) < 1e-3
+
+
+def test_tables():
+    v_grid = np.linspace(-100., 50., 31)
+    v_off = np.linspace(-99.99, 49.99, 1001)
+    for chan in [channelcollection.Na_Ta(), channelcollection.h(),
+                 channelcollection.Kv3_1()]:
+        chan.buildTables(v_min=-100., v_max=50., dv=0.05)
+        # on the grid, only the single precision of the tables matters
+        assert np.allclose(chan.computeVarInf(v_grid), chan.f_varinf_vec(v_grid),
+                           rtol=1e-6, atol=1e-7)
+        assert np.allclose(chan.computeTauInf(v_grid), chan.f_tauinf_vec(v_grid),
+                           rtol=1e-6, atol=1e-7)
+        # between grid points, the linear interpolation error
+        assert np.allclose(chan.computeVarInf(v_off), chan.f_varinf_vec(v_off),
+                           rtol=0., atol=1e-4)
+        assert np.allclose(chan.computeTauInf(v_off), chan.f_tauinf_vec(v_off),
+                           rtol=1e-2, atol=0.)
+        assert chan.computeVarInf(-60.).shape == chan.varnames.shape
+
+        # out of range and complex voltages are evaluated exactly
+        for v in [np.array([-120., -60.]), np.array([-60., 80.]),
+                  np.array([-60. + 1j, -50.])]:
+            assert np.allclose(chan.computeVarInf(v), chan.f_varinf_vec(v),
+                               rtol=1e-12, atol=0.)
+            assert np.allclose(chan.computeTauInf(v), chan.f_tauinf_vec(v),
+                               rtol=1e-12, atol=0.)
+        assert np.allclose(chan.computeVarInf(-120.), chan.f_varinf_vec(-120.),
+                           rtol=1e-12, atol=0.)
+
+        # without tables, evaluation is exact again
+        chan.clearTables()
+        assert np.allclose(chan.computeVarInf(v_off), chan.f_varinf_vec(v_off),
+                           rtol=1e-12, atol=0.)
+        assert np.allclose(chan.computeTauInf(v_off), chan.f_tauinf_vec(v_off),
+                           rtol=1e-12, atol=0.)
+
+
+def test_mod_hash(tmp_path):
+    for chan in [channelcollection.Na_Ta(), channelcollection.h()]:
+        chan.writeModFile(str(tmp_path))
+    mod_hash = ionchannels.modHash(str(tmp_path))
+    assert mod_hash == ionchannels.modHash(str(tmp_path))
+    # other files do not affect the hash
+    (tmp_path / 'notes.txt').write_text('not a mod file')
+    assert ionchannels.modHash(str(tmp_path)) == mod_hash
+
+    # editing a mod file changes the hash
+    mod_file = tmp_path / 'INa_Ta.mod'
+    mod_text = mod_file.read_text()
+    mod_file.write_text(mod_text.replace('THREADSAFE', 'THREADSAFE\n'))
+    assert ionchannels.modHash(str(tmp_path)) != mod_hash
+    mod_file.write_text(mod_text)
+    assert ionchannels.modHash(str(tmp_path)) == mod_hash
+    # as does renaming one
+    mod_file.rename(tmp_path / 'INa_Ta2.mod')
+    assert ionchannels.modHash(str(tmp_path)) != mod_hash
+
+
+def test_max_current():
+    # maxima of the summed linearized current at zero frequency, voltage and
+    # state variables as optimized from the default initialization
+    max_currents = [
+        (channelcollection.Na_Ta, 50., -48.466, 8.7216),
+        (channelcollection.Na_Ta, -85., -44.194, 4.9231),
+        (channelcollection.Kv3_1, 50., -90., 1.3089),
+        (channelcollection.Kv3_1, -85., 0., 2.4057),
+    ]
+    for chan_class, e_rev, v_max, i_max in max_currents:
+        chan = chan_class()
+        v, sv = chan.findMaxCurrent(0., e_rev)
+        assert sv.shape == chan.statevars.shape
+        assert np.all(np.isfinite(sv))
+        assert np.all(sv >= 0.) and np.all(sv <= 1.)
+        assert np.abs(v - v_max) < 0.1
+        i_sum = np.abs(np.sum(chan.computeLinSum(v, 0., e_rev, statevars=sv)))
+        assert i_sum > i_max * (1. - 1e-4)
+
+
+def test_jit_fallback(monkeypatch):
+    # stand-in for numba, whose compiled function raises a typing error for
+    # negative inputs and a division error for zero
+    class NumbaError(Exception):
+        pass
+    jit_calls = []
+    def njit(func, cache=False):
+        def func_jit(x):
+            if x < 0.:
+                raise NumbaError('typing failed')
+            if x == 0.:
+                raise ZeroDivisionError
+            jit_calls.append(x)
+            return func(x)
+        return func_jit
+    errors = types.SimpleNamespace(NumbaError=NumbaError)
+    monkeypatch.setattr(ionchannels, 'numba',
+        types.SimpleNamespace(njit=njit, core=types.SimpleNamespace(errors=errors))
+    )
+
+    f = ionchannels._jit(lambda x: np.float64(1.) / x)
+    assert f(2.) == .5 and jit_calls == [2.]
+    # arithmetic errors are evaluated by numpy, and keep the compiled path
+    with np.errstate(divide='ignore'):
+        assert np.isinf(f(0.))
+    assert f(4.) == .25 and jit_calls == [2., 4.]
+    # compilation errors switch to the original function for good
+    assert f(-1.) == -1.
+    assert f(8.) == .125 and jit_calls == [2., 4.]
+
+
+def test_jit(monkeypatch):
+    pytest.importorskip('numba')
+    chan_classes = [channelcollection.Na_Ta, channelcollection.Kv3_1,
+                    channelcollection.h, channelcollection.TestChannel,
+                    channelcollection.TestChannel2]
+    v_arr = np.array([-75., -60., -50.])
+
+    def evaluate():
+        res = []
+        for chan_class in chan_classes:
+            chan = chan_class()
+            res.append([chan.computePOpen(v_arr),
+                        chan.computeLinSum(v_arr, 10j, 50.),
+                        chan.computeLinSum(-60., 10j, 50.),
+                        chan.computeLinear(v_arr, np.array([0., 10j])[:,None])])
+        res.append(channelcollection.h().findMaxCurrent(0., 50.)[0])
+        return res
+
+    monkeypatch.setattr(IonChannel, '_LAMBDIFY_CACHE', {})
+    res_jit = evaluate()
+    # reference without numba
+    monkeypatch.setattr(IonChannel, '_LAMBDIFY_CACHE', {})
+    monkeypatch.setattr(ionchannels, 'numba', None)
+    res_py = evaluate()
+
+    for vals_jit, vals_py in zip(res_jit[:-1], res_py[:-1]):
+        for val_jit, val_py in zip(vals_jit, vals_py):
+            assert np.allclose(val_jit, val_py)
+    assert np.abs(res_jit[-1] - res_py[-1]) < 1e-3
+
+
+def test_cache_dir(tmp_path):
+    pytest.importorskip('numba')
+    code = (
+        "import sys\n"
+        "from neat.channels.channelcollection import channelcollection\n"
+        "chan = channelcollection.Na_Ta()\n"
+        "if len(sys.argv) > 1:\n"
+        "    # the modules can not be found by name, cached compilations fail\n"
+        "    # to load\n"
+        "    for name in [n for n in sys.modules if n.startswith('neat_lambdified_')]:\n"
+        "        del sys.modules[name]\n"
+        "print(repr(chan.computeLinSum(-60., 10j, 50.)))\n"
+    )
+    env = dict(os.environ, NEAT_CACHE_DIR=str(tmp_path))
+    def run(*args):
+        res = subprocess.run([sys.executable, '-c', code, *args], env=env,
+                             capture_output=True, text=True)
+        assert res.returncode == 0, res.stderr
+        return complex(res.stdout.strip())
+
+    lin_sum = channelcollection.Na_Ta().computeLinSum(-60., 10j, 50.)
+    # cold cache
+    assert np.allclose(run(), lin_sum)
+    assert len(list(tmp_path.glob('neat_lambdified_*.py'))) > 0
+    assert len(list(tmp_path.glob('__pycache__/*.nbi'))) > 0
+    # warm cache
+    assert np.allclose(run(), lin_sum)
+    assert np.allclose(run('unload'), lin_sum)
+
+
 if __name__ == '__main__':
     # tcns = TestChannels()
     # tcns.testBasic()